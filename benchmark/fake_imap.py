@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# coding=utf8
+
+# Stand-in for an IMAP server with a single mailbox: enough of IMAP4rev1
+# and IDLE for the email fetcher of orchestrator.py, without TLS. Messages
+# added while a client idles are announced to it right away.
+
+import argparse
+import email.message
+import email.utils
+import os
+import random
+import re
+import select
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import generate  # noqa: E402
+
+COMMAND = re.compile(rb"^([A-Za-z0-9.]+) ([A-Za-z]+)(?: (.*))?$")
+PARTIAL = re.compile(r"BODY\.PEEK\[([0-9.]*)\]<([0-9]+)\.([0-9]+)>")
+
+
+class Mailbox:
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.messages = []
+        self.next_uid = 1
+
+    def add(self, subject, attachments):
+        # attachments are (filename, content) tuples
+        message = email.message.EmailMessage()
+        message["Subject"] = subject
+        message["Date"] = email.utils.formatdate(localtime=True)
+        message["From"] = "sender@example.com"
+        message.set_content("See attachment")
+        for filename, content in attachments:
+            message.add_attachment(content,
+                                   maintype="application",
+                                   subtype="pdf",
+                                   filename=filename)
+
+        with self.lock:
+            self.messages.append({
+                "uid": self.next_uid,
+                "message": message,
+                "deleted": False
+            })
+            self.next_uid += 1
+            self.lock.notify_all()
+
+    def find(self, uids):
+        # uids is a comma separated list of numbers
+        wanted = set([int(uid) for uid in uids.split(",")])
+        return [
+            message for message in self.messages if message["uid"] in wanted
+        ]
+
+
+def quote(value):
+    if value is None:
+        return "NIL"
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def get_structure(message):
+    if message.is_multipart():
+        children = "".join(
+            [get_structure(part) for part in message.get_payload()])
+        return "({} {})".format(children, quote(message.get_content_subtype()))
+
+    payload = message.get_payload()
+    encoding = message.get("Content-Transfer-Encoding", "7bit")
+    parameters = "NIL"
+    if message.get_param("charset") is not None:
+        parameters = "({} {})".format(quote("charset"),
+                                      quote(message.get_param("charset")))
+
+    disposition = "NIL"
+    if message.get_filename() is not None:
+        disposition = "({} ({} {}))".format(
+            quote(message.get_content_disposition()), quote("filename"),
+            quote(message.get_filename()))
+
+    fields = [
+        quote(message.get_content_maintype()),
+        quote(message.get_content_subtype()), parameters, "NIL", "NIL",
+        quote(encoding),
+        str(len(payload))
+    ]
+    if message.get_content_maintype() == "text":
+        fields.append(str(payload.count("\n")))
+    fields.extend(["NIL", disposition, "NIL"])
+
+    return "(" + " ".join(fields) + ")"
+
+
+def get_part(message, part):
+    for number in part.split("."):
+        message = message.get_payload()[int(number) - 1]
+    return message.get_payload().encode("ascii")
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def send(self, line):
+        self.wfile.write(line.encode("utf-8") + b"\r\n")
+
+    def send_literal(self, prefix, data, suffix):
+        self.wfile.write("{} {{{}}}\r\n".format(prefix, len(data)).encode() +
+                         data + suffix.encode() + b"\r\n")
+
+    def idle(self, tag):
+        mailbox = self.server.mailbox
+        self.send("+ idling")
+        with mailbox.lock:
+            known = len(mailbox.messages)
+
+        # The client ends IDLE with DONE, check for it between waits
+        while True:
+            with mailbox.lock:
+                mailbox.lock.wait(0.2)
+                count = len(mailbox.messages)
+            if count > known:
+                self.send("* {} EXISTS".format(count))
+                known = count
+
+            readable, writable, failed = select.select([self.connection], [],
+                                                       [], 0)
+            if len(readable) == 0:
+                continue
+
+            line = self.rfile.readline()
+            if len(line) == 0 or line.strip().upper() == b"DONE":
+                break
+
+        self.send("{} OK IDLE terminated".format(tag))
+
+    def fetch(self, tag, uids, items):
+        mailbox = self.server.mailbox
+        with mailbox.lock:
+            messages = mailbox.find(uids)
+
+        for number, entry in enumerate(messages, 1):
+            message = entry["message"]
+            prefix = "* {} FETCH (UID {}".format(number, entry["uid"])
+            partial = PARTIAL.search(items)
+            if partial is not None:
+                data = get_part(message, partial.group(1))
+                offset, length = int(partial.group(2)), int(partial.group(3))
+                self.send_literal(
+                    prefix + " BODY[{}]<{}>".format(partial.group(1), offset),
+                    data[offset:offset + length], ")")
+                continue
+
+            if "BODYSTRUCTURE" in items:
+                prefix += " BODYSTRUCTURE " + get_structure(message)
+            header = "Date: {}\r\nSubject: {}\r\n\r\n".format(
+                message["Date"], message["Subject"])
+            self.send_literal(prefix + " BODY[HEADER.FIELDS (DATE SUBJECT)]",
+                              header.encode("utf-8"), ")")
+
+        self.send("{} OK FETCH completed".format(tag))
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send("* OK IMAP4rev1 fake_imap ready")
+
+        while True:
+            line = self.rfile.readline()
+            if len(line) == 0:
+                break
+
+            matches = COMMAND.match(line.strip())
+            if matches is None:
+                self.send("* BAD invalid command")
+                continue
+
+            tag = matches.group(1).decode()
+            command = matches.group(2).decode().upper()
+            arguments = (matches.group(3) or b"").decode()
+
+            if command == "UID":
+                command, arguments = (arguments.split(" ", 1) + [""])[:2]
+                command = "UID " + command.upper()
+
+            if command == "CAPABILITY":
+                self.send("* CAPABILITY IMAP4rev1 IDLE")
+                self.send("{} OK CAPABILITY completed".format(tag))
+            elif command in ["LOGIN", "NOOP", "LOGOUT"]:
+                if command == "LOGOUT":
+                    self.send("* BYE logging out")
+                self.send("{} OK {} completed".format(tag, command))
+                if command == "LOGOUT":
+                    break
+            elif command == "SELECT":
+                with mailbox.lock:
+                    count = len(mailbox.messages)
+                self.send("* {} EXISTS".format(count))
+                self.send("* 0 RECENT")
+                self.send("{} OK [READ-WRITE] SELECT completed".format(tag))
+            elif command == "UID SEARCH":
+                with mailbox.lock:
+                    uids = [
+                        str(message["uid"]) for message in mailbox.messages
+                    ]
+                self.send(" ".join(["* SEARCH"] + uids))
+                self.send("{} OK SEARCH completed".format(tag))
+            elif command == "UID FETCH":
+                uids, items = arguments.split(" ", 1)
+                self.fetch(tag, uids, items)
+            elif command == "UID STORE":
+                with mailbox.lock:
+                    for message in mailbox.find(arguments.split(" ", 1)[0]):
+                        message["deleted"] = True
+                self.send("{} OK STORE completed".format(tag))
+            elif command == "EXPUNGE":
+                with mailbox.lock:
+                    mailbox.messages = [
+                        message for message in mailbox.messages
+                        if not message["deleted"]
+                    ]
+                self.send("{} OK EXPUNGE completed".format(tag))
+            elif command == "IDLE":
+                self.idle(tag)
+            else:
+                self.send("{} BAD unknown command".format(tag))
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def start(port=0):
+    # Serves in the background, returns the server, its port and mailbox
+    server = Server(("127.0.0.1", port), Handler)
+    server.mailbox = Mailbox()
+    threading.Thread(target=server.serve_forever,
+                     name="fake-imap",
+                     daemon=True).start()
+
+    return server, server.server_address[1], server.mailbox
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--interval",
+                        type=float,
+                        default=10,
+                        help="seconds between two generated messages")
+    args = parser.parse_args()
+
+    server, port, mailbox = start(args.port)
+    print("Listening on port {}, run orchestrator.py with EMAIL_SERVER="
+          "127.0.0.1 EMAIL_PORT={} EMAIL_SSL=0".format(port, port))
+
+    rng = random.Random(0)
+    number = 0
+    try:
+        while True:
+            content = generate.get_pdf(
+                [generate.get_text_page(rng, "mail {}".format(number))])
+            mailbox.add("Rechnung {}".format(number),
+                        [("rechnung_{}.pdf".format(number), content)])
+            number += 1
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
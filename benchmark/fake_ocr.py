@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# coding=utf8
+
+# Stand-in for the OCR hot folder product: takes documents out of
+# 03_ocr_in (and 03_ocr_in_<n> for further slots), waits as long as a real
+# OCR run would take and writes the output PDF and a UTF-16 Hot Folder Log
+# into 04_ocr_out, or only a log reporting an error
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import generate  # noqa: E402
+
+LOG_SUCCESS = ("\ufeff{time}: Verarbeitung gestartet\r\n"
+               "Verarbeitete Seiten: {pages}.\r\n"
+               "Erkennungszeit: {hours} Stunden {minutes} Minuten "
+               "{seconds} Sekunden.\r\n"
+               "Fehler/Warnungen: 0 / {warnings}.\r\n"
+               "Nicht eindeutige Zeichen: {percent} % "
+               "({wrong} / {total}).\r\n")
+LOG_FAILURE = ("\ufeff{time}: Fehler: Datei kann nicht gelesen werden\r\n"
+               "Verarbeitete Seiten: 0.\r\n"
+               "Erkennungszeit: 0 Stunden 0 Minuten 0 Sekunden.\r\n"
+               "Fehler/Warnungen: 1 / 0.\r\n")
+
+
+def write_atomic(pathname, content):
+    temporary = os.path.join(os.path.dirname(pathname),
+                             ".{}.part".format(uuid.uuid4().hex))
+    with open(temporary, "wb") as file:
+        file.write(content)
+    os.rename(temporary, pathname)
+
+
+def get_slot_directories(root, slot):
+    if slot == 0:
+        return os.path.join(root, "03_ocr_in"), os.path.join(root,
+                                                             "04_ocr_out")
+
+    return (os.path.join(root, "03_ocr_in_{:d}".format(slot)),
+            os.path.join(root, "04_ocr_out_{:d}".format(slot)))
+
+
+def run_slot(root, slot, latency, per_page, failure_rate, stop, seed=0):
+    # Works on one document at a time, like a single hot folder
+    rng = random.Random(seed + slot)
+    ocr_in, ocr_out = get_slot_directories(root, slot)
+    failed = set()
+
+    while not stop.is_set():
+        try:
+            files = sorted([
+                file for file in os.listdir(ocr_in)
+                if file.lower().endswith(".pdf") and file not in failed
+            ])
+            busy = len(os.listdir(ocr_out)) > 0
+        except FileNotFoundError:
+            files = []
+
+        # Output of the last run has not been picked up yet
+        if len(files) == 0 or busy:
+            stop.wait(0.1)
+            continue
+
+        filename = files[0]
+        pathname = os.path.join(ocr_in, filename)
+        pages = max(generate.get_page_count(pathname), 1)
+
+        duration = (latency + per_page * pages) * rng.uniform(0.8, 1.2)
+        if stop.wait(duration):
+            break
+
+        now = datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+        if rng.random() < failure_rate:
+            # The input stays in place, the orchestrator moves it away
+            log = LOG_FAILURE.format(time=now)
+            failed.add(filename)
+        else:
+            with open(pathname, "rb") as file:
+                content = file.read()
+            write_atomic(os.path.join(ocr_out, filename),
+                         content + b"% ocr " + uuid.uuid4().hex.encode())
+            os.unlink(pathname)
+
+            total = pages * rng.randint(1500, 2500)
+            wrong = int(total * rng.uniform(0, 0.03))
+            seconds = int(duration)
+            log = LOG_SUCCESS.format(time=now,
+                                     pages=pages,
+                                     hours=seconds // 3600,
+                                     minutes=seconds // 60 % 60,
+                                     seconds=seconds % 60,
+                                     warnings=rng.randint(0, 3),
+                                     percent=wrong * 100 // total,
+                                     wrong=wrong,
+                                     total=total)
+
+        write_atomic(os.path.join(ocr_out, "Hot Folder Log.txt"),
+                     log.encode("utf-16le"))
+
+
+def start(root, slots=1, latency=2.0, per_page=0.5, failure_rate=0.05,
+          seed=0):
+    # Runs one thread per slot, returns the event stopping them
+    stop = threading.Event()
+    for slot in range(slots):
+        threading.Thread(target=run_slot,
+                         args=(root, slot, latency, per_page, failure_rate,
+                               stop, seed),
+                         name="fake-ocr-{}".format(slot),
+                         daemon=True).start()
+
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory")
+    parser.add_argument("--slots", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=2.0)
+    parser.add_argument("--per-page", type=float, default=0.5)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    stop = start(args.directory, args.slots, args.latency, args.per_page,
+                 args.failure_rate)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()
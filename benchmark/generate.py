@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+# coding=utf8
+
+# Generator of synthetic input documents for the benchmarks: small but valid
+# PDFs with a text layer or only a scanned image, named in every format the
+# filename parsers of orchestrator.py accept
+
+import argparse
+import datetime
+import os
+import random
+import re
+import uuid
+import zlib
+
+# Source directory and filename format, the argument is the number of the
+# document and a timestamp unique to it
+FORMATS = [
+    ("01_scanner", lambda number, when: "{:%Y%m%d_%H%M%S}_{:06x}_{}.pdf".
+     format(when, number, number % 100)),
+    ("01_mobile",
+     lambda number, when: "scan_{:%Y-%m-%d-%H.%M-%S}.pdf".format(when)),
+    ("01_mobile", lambda number, when: "scan_{:%Y-%m-%d-%H.%M-%S} {}.pdf".
+     format(when, number)),
+    ("01_mobile",
+     lambda number, when: "IMG_{:%Y%m%d}_{:04d}.pdf".format(when, number)),
+    ("01_mobile", lambda number, when:
+     "bench-{:05d}-{:%Y-%m-%d-%H-%M-%S}-scanner.pdf".format(number, when)),
+    ("01_mobile", lambda number, when: "{:%Y_%m_%d_%H_%M_%S}_photo.pdf".
+     format(when)),
+    ("01_mobile", lambda number, when: "upload {}.pdf".format(number)),
+    ("01_email", lambda number, when: "{}-{}-{}--Rechnung_{}.pdf".format(
+        when.year, when.month, when.day, number)),
+]
+
+WORDS = [
+    "Rechnung", "Vertrag", "Kunde", "Betrag", "Datum", "Zahlung", "Konto",
+    "invoice", "contract", "customer", "amount", "payment", "account",
+    "Versicherung", "Steuer", "Bescheid", "Mahnung", "Lieferung", "Angebot"
+]
+
+PAGE_COUNT = re.compile(rb"/Type\s*/Page\b")
+
+
+def get_pdf(pages):
+    # Assembles a PDF from one content stream per page, pages are tuples
+    # (content, image) where image is None or (width, height, pixels)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+
+    for content, image in pages:
+        resources = b"/Font << /F1 3 0 R >>"
+        if image is not None:
+            width, height, pixels = image
+            data = zlib.compress(pixels)
+            objects.append(
+                b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                b"/ColorSpace /DeviceGray /BitsPerComponent 8 "
+                b"/Filter /FlateDecode /Length %d >>\nstream\n" %
+                (width, height, len(data)) + data + b"\nendstream")
+            resources += b" /XObject << /Im1 %d 0 R >>" % len(objects)
+
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) +
+                       content + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R "
+                       b"/MediaBox [0 0 595 842] /Resources << " +
+                       resources + b" >> /Contents %d 0 R >>" %
+                       len(objects))
+        kids.append(b"%d 0 R" % len(objects))
+
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(kids) + \
+        b"] /Count %d >>" % len(kids)
+
+    output = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1)
+    output += b"startxref\n%d\n%%%%EOF\n" % xref
+
+    return output
+
+
+def get_text_page(rng, token):
+    lines = [token] + [
+        " ".join([rng.choice(WORDS) for word in range(10)])
+        for line in range(30)
+    ]
+
+    content = b"BT /F1 11 Tf 60 780 Td 14 TL"
+    for line in lines:
+        content += b" (" + line.encode("latin-1") + b") '"
+    content += b" ET"
+
+    return content, None
+
+
+def get_image_page(rng, token):
+    # Grey noise with dark bars standing in for lines of text, the token
+    # is an invisible text fragment making every document unique
+    width, height = 300, 420
+    light = [
+        bytes([230 + rng.randrange(25) for x in range(width)])
+        for row in range(16)
+    ]
+    dark = [
+        bytes([40 + rng.randrange(30) for x in range(width)])
+        for row in range(16)
+    ]
+
+    rows = []
+    for y in range(height):
+        row = rng.choice(light)
+        if (y // 6) % 3 == 0 and 30 < y < height - 30:
+            end = width - 25 - (y % 7) * 15
+            row = row[:25] + rng.choice(dark)[25:end] + row[end:]
+        rows.append(row)
+
+    content = b"q 595 0 0 842 0 0 cm /Im1 Do Q BT 3 Tr /F1 1 Tf 1 1 Td (" + \
+        token.encode("latin-1") + b") Tj ET"
+
+    return content, (width, height, b"".join(rows))
+
+
+def get_page_count(pathname):
+    with open(pathname, "rb") as file:
+        return len(PAGE_COUNT.findall(file.read()))
+
+
+def generate(directory, count, image_ratio=0.5, pages=(1, 5), seed=0):
+    # Writes count documents below directory into the source directories
+    # of their format, returns their paths relative to directory
+    rng = random.Random(seed)
+    start = datetime.datetime(2021, 1, 1, 8, 0, 0)
+    documents = []
+
+    for number in range(count):
+        source, get_filename = FORMATS[number % len(FORMATS)]
+        when = start + datetime.timedelta(minutes=number, seconds=number)
+        filename = get_filename(number, when)
+
+        token = "bench {} {}".format(number, uuid.uuid4().hex)
+        if rng.random() < image_ratio:
+            get_page = get_image_page
+        else:
+            get_page = get_text_page
+        content = get_pdf([
+            get_page(rng, token)
+            for page in range(rng.randint(pages[0], pages[1]))
+        ])
+
+        os.makedirs(os.path.join(directory, source), exist_ok=True)
+        pathname = os.path.join(directory, source, filename)
+        temporary = os.path.join(directory, source,
+                                 ".{}.part".format(uuid.uuid4().hex))
+        with open(temporary, "wb") as file:
+            file.write(content)
+        os.rename(temporary, pathname)
+
+        documents.append(os.path.join(source, filename))
+
+    return documents
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory")
+    parser.add_argument("--count", type=int, default=50)
+    parser.add_argument("--image-ratio", type=float, default=0.5)
+    parser.add_argument("--min-pages", type=int, default=1)
+    parser.add_argument("--max-pages", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for document in generate(args.directory, args.count, args.image_ratio,
+                             (args.min_pages, args.max_pages), args.seed):
+        print(document)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# coding=utf8
+
+# Micro-benchmark of filename parsing: the former chain of parse_*_filename
+# functions against the parser registry of orchestrator.py
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import orchestrator  # noqa: E402
+
+CORPUS = [
+    "scan_2021-01-08-08.43-37.pdf",
+    "scan_2020-11-08-06.23-49 39.pdf",
+    "20210112_103412_2c4f9a_17.pdf",
+    "20201224_080002_ABCDEF_3.pdf",
+    "IMG_20210202_0001.pdf",
+    "IMG_20210202_0002(1).pdf",
+    "box00001-00008-2018-01-01-00-09-55-scanner.pdf",
+    "None-00443-2020-11-08-08-37-37-mobile-scan_2020-11-08-06.23-49 39.pdf",
+    "2021-1-18--VERTRAGSRELEVANTE_DOKUMENTE_dat20200928_id909128141.pdf",
+    "2020-12-3--Rechnung_4711.pdf",
+    "Document 2021-03-04 10.11.12.pdf",
+    "2021_03_04_10_11_12_photo.pdf",
+    "random upload.pdf",
+]
+
+# The patterns as they were matched by the parse_*_filename functions
+LEGACY = [
+    (r"^[a-z]*[\.\-_]{1}([0-9]{2,4})[\.\-_]{1}([0-9]{1,2})" +
+     r"[\.\-_]{1}([0-9]{1,2})[\.\-_]{1}([0-9]{1,2})[\.\-_]{1}" +
+     r"([0-9]{1,2})[\.\-_]{1}([0-9]{1,2}).*\.pdf$", False,
+     orchestrator.build_scanned_name),
+    (r"^([0-9]{4})([0-9]{2})([0-9]{2})_([0-9]{2})([0-9]{2})" +
+     r"([0-9]{2})_[0-9a-zA-Z]+_[0-9]+\.pdf$", False,
+     orchestrator.build_scanned_name),
+    (r"IMG_([0-9]{4})([0-9]{2})([0-9]{2})_([0-9]+)[0-9\(\)]*.pdf$", False,
+     orchestrator.build_canon_name),
+    (orchestrator.REGEX_ORCHESTRATOR, True,
+     orchestrator.build_orchestrated_name),
+    (r"([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})--(.*)$", True,
+     orchestrator.build_email_name),
+    (r"([0-9]{4})[\-\._]{1}([0-9]{2})[\-\._]{1}([0-9]{2})" +
+     r"[\-\._]{1}([0-9]{2})[\-\._]{1}([0-9]{2})[\-\._]{1}([0-9]{2})" +
+     r".*\.pdf$", False, orchestrator.build_scanned_name),
+]
+
+
+def legacy_parse(filename, prefix, index, suffix):
+    for regex, stem, build in LEGACY:
+        filename_no_ext, file_extension = os.path.splitext(filename)
+        if stem:
+            matches = re.match(regex, filename_no_ext, re.IGNORECASE)
+        else:
+            matches = re.match(regex, filename, re.IGNORECASE)
+
+        if matches is not None:
+            return build(matches, filename, prefix, index, suffix)
+
+    return None
+
+
+def registry_parse(filename, prefix, index, suffix):
+    parser, matches = orchestrator.match_filename(filename)
+    if parser is None:
+        return None
+
+    return parser["build"](matches, filename, prefix, index, suffix)
+
+
+def main():
+    orchestrator.load_filename_parsers(os.devnull)
+
+    for filename in CORPUS:
+        legacy = legacy_parse(filename, "box", 1, "scanner")
+        registry = registry_parse(filename, "box", 1, "scanner")
+        if legacy != registry:
+            print("Mismatch for {}: {} vs. {}".format(filename, legacy,
+                                                      registry))
+
+    rounds = 2000
+    for label, function in [("legacy", legacy_parse),
+                            ("registry", registry_parse)]:
+        duration = min(
+            timeit.repeat(lambda: [
+                function(filename, "box", 1, "scanner")
+                for filename in CORPUS
+            ],
+                          number=rounds,
+                          repeat=5))
+        print("{:10s} {:8.2f} us per filename".format(
+            label, duration * 1e6 / (rounds * len(CORPUS))))
+
+    print("Hits: {}".format(orchestrator.get_parser_hits()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+# coding=utf8
+
+# End-to-end throughput benchmark: runs orchestrator.py in a scratch
+# directory against the fake OCR hot folder, drops generated documents into
+# its input directories, consumes what comes out and reports documents per
+# minute, latencies and the cost of every stage from the metrics file
+
+import argparse
+import os
+import re
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_ocr  # noqa: E402
+import generate  # noqa: E402
+
+ORCHESTRATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                            "orchestrator.py")
+
+METRIC = re.compile(r'^(orchestrator_[a-z_]+)_(sum|count)'
+                    r'\{[a-z]+="([a-z_]+)"\} ([0-9.e+-]+)$')
+
+
+def percentile(values, fraction):
+    # Nearest rank
+    if len(values) == 0:
+        return float("nan")
+
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def get_originals(workdir, names):
+    # Maps orchestrated names back to the names the documents came in with
+    path = os.path.join(workdir, "config", "documents.db")
+    if not os.path.isfile(path):
+        return
+
+    connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        for name, name_original in connection.execute(
+                'SELECT name, name_original FROM documents'):
+            names[name] = name_original
+    except sqlite3.OperationalError:
+        pass
+    finally:
+        connection.close()
+
+
+def read_stages(pathname):
+    stages = {}
+    if not os.path.isfile(pathname):
+        return stages
+
+    with open(pathname) as file:
+        for line in file:
+            matches = METRIC.match(line.strip())
+            if matches is None:
+                continue
+
+            metric, kind, label, value = matches.groups()
+            key = (metric.replace("orchestrator_", ""), label)
+            stages.setdefault(key, {})[kind] = float(value)
+
+    return stages
+
+
+def wait_for_directories(workdir, process, timeout=30):
+    start = time.time()
+    while not os.path.isdir(os.path.join(workdir, "05_consumption")):
+        if process.poll() is not None or (time.time() - start) > timeout:
+            raise RuntimeError("orchestrator did not start")
+        time.sleep(0.1)
+
+
+def run(args, workdir):
+    os.makedirs(os.path.join(workdir, "config"), exist_ok=True)
+    with open(os.path.join(workdir, "config", "PREFIX"), "w") as file:
+        file.write("bench\n")
+
+    staging = os.path.join(workdir, "staging")
+    documents = generate.generate(staging, args.documents, args.image_ratio,
+                                  (args.min_pages, args.max_pages))
+
+    environment = dict(os.environ)
+    environment.update({
+        "OCR_SLOTS": str(args.slots),
+        "METRICS_FILE": os.path.join("logs", "metrics.prom"),
+        "METRICS_INTERVAL": "1",
+        "POLL_INTERVAL_CONSUMPTION": "1",
+        "STABLE_INTERVAL": str(args.stable_interval),
+    })
+
+    log = open(os.path.join(workdir, "orchestrator.out"), "w")
+    process = subprocess.Popen([sys.executable, ORCHESTRATOR],
+                               cwd=workdir,
+                               env=environment,
+                               stdout=log,
+                               stderr=subprocess.STDOUT)
+    stop = None
+
+    try:
+        wait_for_directories(workdir, process)
+        stop = fake_ocr.start(workdir, args.slots, args.latency,
+                              args.per_page, args.failure_rate)
+
+        dropped = {}
+        finished = {}
+        names = {}
+        interval = 0
+        if args.rate > 0:
+            interval = 60.0 / args.rate
+
+        start = time.time()
+        pending = list(documents)
+        next_drop = start
+
+        while len(finished) < len(documents):
+            now = time.time()
+            if (now - start) > args.timeout:
+                print("Timeout after {:.0f} s".format(now - start))
+                break
+
+            if process.poll() is not None:
+                print("orchestrator exited with {}".format(process.returncode))
+                break
+
+            while len(pending) > 0 and now >= next_drop:
+                document = pending.pop(0)
+                os.rename(os.path.join(staging, document),
+                          os.path.join(workdir, document))
+                dropped[os.path.basename(document)] = time.time()
+                next_drop += interval
+
+            # Consume like the document management system would
+            get_originals(workdir, names)
+            for directory, state in [("05_consumption", "consumed"),
+                                     ("04_ocr_fail", "failed"),
+                                     ("01_fail", "failed")]:
+                for file in os.listdir(os.path.join(workdir, directory)):
+                    original = names.get(file, file)
+                    if original in dropped and original not in finished:
+                        finished[original] = (time.time(), state)
+                    if directory == "05_consumption":
+                        os.unlink(os.path.join(workdir, directory, file))
+
+            time.sleep(0.1)
+
+        # Let the last metrics be written
+        time.sleep(1.5)
+        stages = read_stages(os.path.join(workdir, "logs", "metrics.prom"))
+    finally:
+        if stop is not None:
+            stop.set()
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+        log.close()
+
+    latencies = [
+        finished[original][0] - dropped[original] for original in finished
+        if finished[original][1] == "consumed"
+    ]
+    failed = len([
+        original for original in finished
+        if finished[original][1] == "failed"
+    ])
+    if len(finished) > 0:
+        duration = max([done for done, state in finished.values()]) - start
+    else:
+        duration = time.time() - start
+
+    print("Documents:   {} dropped, {} consumed, {} failed, {} unfinished".
+          format(len(dropped), len(latencies), failed,
+                 len(dropped) - len(finished)))
+    print("Throughput:  {:.1f} docs/min over {:.1f} s".format(
+        len(finished) * 60 / max(duration, 1e-9), duration))
+    print("Latency:     p50 {:.2f} s, p99 {:.2f} s".format(
+        percentile(latencies, 0.5), percentile(latencies, 0.99)))
+    print("Stages:")
+    for (metric, label), values in sorted(stages.items()):
+        count = values.get("count", 0)
+        if count == 0:
+            continue
+        print("  {:14s} {:12s} {:6.0f} x {:10.2f} ms = {:8.2f} s".format(
+            metric, label, count, values["sum"] * 1000 / count,
+            values["sum"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--rate",
+                        type=float,
+                        default=0,
+                        help="documents per minute, 0 drops all at once")
+    parser.add_argument("--slots", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--per-page", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--image-ratio", type=float, default=0.5)
+    parser.add_argument("--min-pages", type=int, default=1)
+    parser.add_argument("--max-pages", type=int, default=5)
+    parser.add_argument("--stable-interval", type=float, default=0.2)
+    parser.add_argument("--timeout", type=float, default=1800)
+    parser.add_argument("--workdir", help="kept after the run if given")
+    args = parser.parse_args()
+
+    if args.workdir is not None:
+        run(args, args.workdir)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="orchestrator-benchmark-")
+    try:
+        run(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,31 +7,51 @@ import time
 import re
 import shutil
 import sqlite3
+import contextlib
 import hashlib
 import glob
+import uuid
+import sys
+import fcntl
+import signal
+import threading
+import concurrent.futures
+import select
+import struct
+import ctypes
+import ctypes.util
+import zlib
+import mmap
+import tempfile
+import json
+import http.server
+import imaplib
+import email
+import email.header
+import email.errors
+import email.utils
+import base64
+import quopri
+import ssl
 from datetime import datetime
 import subprocess
+import shlex
+import queue
 import pdftotext
 
-DB_CONNECTION = None
-
-
-def get_hash(filename):
-    sha256_hash = hashlib.sha256()
-    with open(filename, "rb") as file_handle:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: file_handle.read(4096), b""):
-            sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
-
-
-def open_database(config):
-    global DB_CONNECTION
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-    connection = sqlite3.connect(os.path.join(config, 'documents.db'))
+DB_CONNECTION = None
+DB_LOCK = threading.RLock()
+DB_DEPTH = 0
 
-    cursor = connection.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS documents (
+# Schema migrations, PRAGMA user_version holds the number applied
+MIGRATIONS = [
+    [
+        '''CREATE TABLE IF NOT EXISTS documents (
             name TEXT UNIQUE,
             hash_ocr VARCHAR(64) UNIQUE,
             name_original TEXT,
@@ -44,121 +64,1161 @@ def open_database(config):
             ocr_warnings INTEGER,
             ocr_chars_total INTEGER,
             ocr_chars_wrong INTEGER
-            )''')
-    connection.commit()
-
-    cursor = connection.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS document_logs (
+            )''',
+        '''CREATE TABLE IF NOT EXISTS document_logs (
             name TEXT,
             timestamp TEXT,
             log TEXT
-            )''')
-    connection.commit()
+            )''',
+        '''CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER
+            )''',
+    ],
+    [
+        'CREATE INDEX documents_status ON documents (status)',
+        'CREATE INDEX documents_last_update ON documents (last_update)',
+        'CREATE INDEX document_logs_name ON document_logs (name)',
+    ],
+    [
+        'ALTER TABLE documents ADD COLUMN time_ocred TEXT',
+        'ALTER TABLE documents ADD COLUMN time_consumed TEXT',
+        'ALTER TABLE documents ADD COLUMN consumption_latency REAL',
+    ],
+    [
+        '''CREATE TABLE text_layers (
+            hash VARCHAR(64) PRIMARY KEY,
+            needs_ocr INTEGER,
+            length INTEGER
+            )''',
+    ],
+    [
+        '''CREATE TABLE similarities (
+            name TEXT PRIMARY KEY,
+            text BLOB,
+            image TEXT
+            )''',
+        '''CREATE TABLE similarity_bands (
+            kind TEXT,
+            band INTEGER,
+            bucket TEXT,
+            name TEXT
+            )''',
+        '''CREATE INDEX similarity_bands_bucket
+            ON similarity_bands (kind, band, bucket)''',
+    ],
+    [
+        'ALTER TABLE documents ADD COLUMN pages INTEGER',
+    ],
+    [
+        'ALTER TABLE documents ADD COLUMN trace_id TEXT',
+    ],
+    [
+        '''CREATE TABLE journal (
+            name TEXT,
+            state TEXT,
+            timestamp TEXT,
+            source TEXT,
+            signature TEXT
+            )''',
+        'CREATE INDEX journal_name ON journal (name)',
+        'CREATE INDEX journal_source ON journal (source, signature)',
+    ],
+    [
+        '''CREATE TABLE hashes (
+            device INTEGER,
+            inode INTEGER,
+            size INTEGER,
+            mtime_ns INTEGER,
+            hash VARCHAR(64),
+            PRIMARY KEY (device, inode, size, mtime_ns)
+            )''',
+    ],
+    [
+        'ALTER TABLE documents ADD COLUMN ocr_predicted REAL',
+        'ALTER TABLE documents ADD COLUMN ocr_deadline REAL',
+        'ALTER TABLE documents ADD COLUMN ocr_duration REAL',
+    ],
+    [
+        'ALTER TABLE documents ADD COLUMN repair_result TEXT',
+        'ALTER TABLE documents ADD COLUMN time_repaired TEXT',
+    ],
+    [
+        'ALTER TABLE documents ADD COLUMN archive_raw TEXT',
+        'ALTER TABLE documents ADD COLUMN archive_ocr TEXT',
+    ],
+]
+
+# Every transition of a document is appended to the journal, documents whose
+# last one is resumable are picked up again by recover_documents()
+JOURNAL_RESUMABLE = ("ingested", "archived", "repairing", "queued", "ocring")
+
+# Names of all documents waiting in consumption, guarded by DB_LOCK
+PENDING_CONSUMPTION = set()
+
+# A document with more characters of text than this does not need OCR.
+# Documents with more than TEXT_LAYER_PAGES pages are only sampled at the
+# first, middle and last page.
+TEXT_LAYER_THRESHOLD = 50
+TEXT_LAYER_PAGES = int(os.environ.get("TEXT_LAYER_PAGES", 20))
+
+# Near duplicates of known documents are only flagged in the document log
+# or, with DUPLICATE_ACTION=skip, kept out of OCR. They are found by a
+# MinHash of the text or, for scans without text, a difference hash of the
+# first page. The byte buckets of the latter only work below 8 bits.
+DUPLICATE_ACTION = os.environ.get("DUPLICATE_ACTION", "flag")
+SIMILARITY_THRESHOLD = float(os.environ.get("SIMILARITY_THRESHOLD", 0.8))
+DHASH_DISTANCE = min(int(os.environ.get("DHASH_DISTANCE", 6)), 7)
+SHINGLE_WORDS = 3
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_PRIME = (1 << 61) - 1
+
+# Stored signatures depend on these, so they are derived deterministically
+MINHASH_SEEDS = []
+for seed in range(MINHASH_PERMUTATIONS):
+    digest = hashlib.sha256(b"minhash" + bytes([seed])).digest()
+    MINHASH_SEEDS.append(
+        (int.from_bytes(digest[:8], "little") % (MINHASH_PRIME - 1) + 1,
+         int.from_bytes(digest[8:16], "little") % MINHASH_PRIME))
+
+# Header of the binary greymaps rendered by mutool
+PGM_HEADER = re.compile(rb"P5\s+([0-9]+)\s+([0-9]+)\s+([0-9]+)\s")
+
+# Order of the OCR queue (hrrn, sjf or fifo) and the weight of each source,
+# see order_ocr_queue()
+QUEUE_POLICY = os.environ.get("QUEUE_POLICY", "hrrn")
+QUEUE_WEIGHTS = {}
+for entry in os.environ.get("QUEUE_WEIGHTS",
+                            "scanner=2,mobile=2,email=1").split(","):
+    if "=" in entry:
+        source, weight = entry.split("=", 1)
+        QUEUE_WEIGHTS[source.strip()] = float(weight)
+
+# OCR time estimate in seconds, see get_ocr_model()
+OCR_MODEL = {"fixed": 30.0, "per_page": 15.0, "rate": None, "updated": 0}
+
+# Page counts of queued documents not known to the database
+QUEUE_PAGES = {}
+
+# Size of the ingestion worker pool, limited per source with
+# INGEST_LIMIT_<SOURCE>
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 4))
+
+# Set by SIGTERM/SIGINT, the main loop drains the workers and exits
+SHUTDOWN = threading.Event()
+
+# Format: box00001-00008-2018-01-01-00-09-55-scanner.pdf
+REGEX_ORCHESTRATOR = r"([a-z0-9]+)-([0-9]+)-([0-9]+)-([0-9]+)-" + \
+        r"([0-9]+)-([0-9]+)-([0-9]+)-([0-9]+)-([a-z0-9]+)[-]*(.*)$"
+ORCHESTRATED_REGEX = re.compile(REGEX_ORCHESTRATOR, re.IGNORECASE)
+
+# Filename parsers in dispatch order, see load_filename_parsers()
+FILENAME_PARSERS = []
+
+# Statistics in Hot Folder Logs, dispatched on the prefix of the line
+OCR_LOG_FIELDS = [
+    (("Verarbeitete Seiten", "Pages processed"), "Pages",
+     re.compile(r"^(?:Verarbeitete Seiten|Pages processed):[ \t]*([0-9]+).$")),
+    (("Erkennungszeit", "Recognition time"), "Time",
+     re.compile(
+         r"^(?:Erkennungszeit|Recognition time):[ \t]*([0-9]+) " +
+         r"(?:Stunden|hours) ([0-9]+) (?:Minuten|minutes) ([0-9]+) " +
+         r"(?:Sekunden|seconds).$")),
+    (("Fehler/Warnungen", "Errors/warnings"), "Errors",
+     re.compile(r"^(?:Fehler/Warnungen|Errors/warnings ):[ \t]*([0-9]+) / " +
+                r"([0-9]+).$")),
+    (("Nicht eindeutige Zeichen", "Low-confidence characters"), "Chars",
+     re.compile(r"^(?:Nicht eindeutige Zeichen|Low-confidence characters):" +
+                r"[ \t]*([0-9]+) % \(([0-9]+) / ([0-9]+)\).$")),
+]
+OCR_LOG_REASON = re.compile(r"^[0-9\., :\t]+(?:Fehler|Error): (.*)$")
+
+# Number of OCR hot folders to keep busy and how long OCR may take in each,
+# override per slot with OCR_TIMEOUT_<n>
+OCR_SLOTS = int(os.environ.get("OCR_SLOTS", 1))
+OCR_TIMEOUT = float(os.environ.get("OCR_TIMEOUT", 3600))
+
+# Deadline of a document in OCR: OCR_TIMEOUT_MARGIN times its pages at the
+# OCR_TIMEOUT_PERCENTILE of the seconds per page seen so far, but at least
+# OCR_TIMEOUT_MINIMUM. Without history OCR_TIMEOUT applies.
+OCR_TIMEOUT_PERCENTILE = float(os.environ.get("OCR_TIMEOUT_PERCENTILE",
+                                              0.95))
+OCR_TIMEOUT_MARGIN = float(os.environ.get("OCR_TIMEOUT_MARGIN", 2))
+OCR_TIMEOUT_MINIMUM = float(os.environ.get("OCR_TIMEOUT_MINIMUM", 300))
+
+# OCR either runs through an external hot folder product or locally with
+# OCR_COMMAND (OCR_BACKEND=local) in up to OCR_WORKERS processes, which
+# share the cores between them. Pages that already have text are passed
+# through instead of failing the document.
+OCR_BACKEND = os.environ.get("OCR_BACKEND", "hotfolder")
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", os.cpu_count() or 1))
+OCR_COMMAND = os.environ.get("OCR_COMMAND", "ocrmypdf")
+OCR_ARGUMENTS = shlex.split(
+    os.environ.get(
+        "OCR_ARGUMENTS", "--skip-text --jobs {:d} -l deu+eng".format(
+            max(1, (os.cpu_count() or 1) // OCR_WORKERS))))
+OCR_WARNING = re.compile(r"\bwarning\b", re.IGNORECASE)
+
+# Damaged PDFs are cleaned by up to REPAIR_WORKERS mutool processes before
+# they are queued for OCR
+REPAIR_WORKERS = int(os.environ.get("REPAIR_WORKERS", 2))
+REPAIR_TIMEOUT = float(os.environ.get("REPAIR_TIMEOUT", 300))
+
+# Counters and histograms exposed by render_metrics(), guarded by
+# METRICS_LOCK
+METRICS = {"counters": {}, "histograms": {}, "directories": {}}
+METRICS_LOCK = threading.Lock()
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300,
+                   600, 1800, 3600, 86400, float("inf"))
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", 60))
+
+# Trace-event JSON written if TRACE_FILE is set, guarded by TRACE_LOCK. The
+# correlation ID of the document a thread works on is in TRACE_CONTEXT.
+TRACE = {"file": None}
+TRACE_LOCK = threading.Lock()
+TRACE_CONTEXT = threading.local()
+
+# IMAP account polled if the server does not support IDLE, the IDLE is
+# renewed before servers drop it after 30 minutes
+EMAIL_IDLE_TIMEOUT = float(os.environ.get("EMAIL_IDLE_TIMEOUT", 1500))
+EMAIL_POLL_INTERVAL = float(os.environ.get("EMAIL_POLL_INTERVAL", 600))
+EMAIL_CHUNK_SIZE = 1024 * 1024
+EMAIL_UNSAFE = re.compile(r"[^\w.-]+")
+
+# Tokens of IMAP responses, a section like BODY[HEADER.FIELDS (DATE)] stays
+# one atom
+IMAP_LITERAL = re.compile(rb"\{[0-9]+\}\s*$")
+IMAP_TOKEN = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|'
+                        rb'[^\s()"\[]+(?:\[[^\]]*\][^\s()"]*)?')
+
+# Ingress files are mirrored in the background, MIRROR_SAMPLE_RATE of them
+# (chosen by filename), optionally zstd compressed. Files not fitting into
+# the queue are dropped or spilled to disk (MIRROR_OVERFLOW=spill) and
+# mirrored once the writer has caught up.
+MIRROR_QUEUE_SIZE = int(os.environ.get("MIRROR_QUEUE_SIZE", 64))
+MIRROR_SAMPLE_RATE = float(os.environ.get("MIRROR_SAMPLE_RATE", 1))
+MIRROR_COMPRESSION = os.environ.get("MIRROR_COMPRESSION", "none")
+MIRROR_OVERFLOW = os.environ.get("MIRROR_OVERFLOW", "drop")
+
+# Archives are sharded into year/month directories by the date in the
+# document name (ARCHIVE_LAYOUT=month) or kept flat (ARCHIVE_LAYOUT=flat).
+# The path of every archived file is kept in documents.
+ARCHIVE_LAYOUT = os.environ.get("ARCHIVE_LAYOUT", "month")
+ARCHIVE_WORKERS = int(os.environ.get("ARCHIVE_WORKERS", 8))
+
+# Buffer size for streaming copies
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Threads hashing files in bulk, see get_hashes()
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 1))
+
+# ioctl cloning a file on copy-on-write filesystems (see ioctl_ficlone(2))
+FICLONE = 0x40049409
+
+# inotify event flags (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Events telling that a file has landed in (or left) a watched directory
+WATCH_MASKS = {
+    "scanner_in": IN_CLOSE_WRITE | IN_MOVED_TO,
+    "mobile_in": IN_CLOSE_WRITE | IN_MOVED_TO,
+    "email_in": IN_CLOSE_WRITE | IN_MOVED_TO,
+    "ocr_queue": IN_CLOSE_WRITE | IN_MOVED_TO,
+    "ocr_repair": IN_CLOSE_WRITE | IN_MOVED_TO,
+    "ocr_in": IN_DELETE | IN_MOVED_FROM,
+    "ocr_out": IN_CLOSE_WRITE | IN_MOVED_TO,
+    "consumption": IN_DELETE | IN_MOVED_FROM,
+}
+
+# Number of identical (size, mtime, inode) samples taken STABLE_INTERVAL
+# seconds apart before a file is considered completely written
+STABLE_SAMPLES = int(os.environ.get("STABLE_SAMPLES", 3))
+STABLE_INTERVAL = float(os.environ.get("STABLE_INTERVAL", 1))
+
+# Stability state of all candidate files, keyed by path
+STABILITY = {}
+
+# Fallback polling intervals in seconds, override with POLL_INTERVAL_<DIR>
+POLL_INTERVALS = {
+    "scanner_in": 6,
+    "mobile_in": 6,
+    "email_in": 6,
+    "ocr_out": 5,
+    "ocr_queue": 30,
+    "ocr_repair": 30,
+    "consumption": 600,
+}
+
+
+def observe(name, labels, value):
+    # Adds value to the histogram name{labels}
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        histogram = METRICS["histograms"].get(key)
+        if histogram is None:
+            histogram = {
+                "buckets": [0] * len(METRICS_BUCKETS),
+                "sum": 0.0,
+                "count": 0
+            }
+            METRICS["histograms"][key] = histogram
+
+        for index, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def increment(name, labels, value=1):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        METRICS["counters"][key] = METRICS["counters"].get(key, 0) + value
+
+
+@contextlib.contextmanager
+def timed(stage, args=None):
+    # Observes a stage of the document handled by the current thread
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        observe("orchestrator_stage_seconds", {"stage": stage}, end - start)
+        trace_span(stage, get_current_trace(), start, end, args)
+
+
+def open_trace(pathname):
+    # Tracing is opt-in, events are appended to a Chrome trace-event JSON
+    # array which may be left open
+    if pathname is None:
+        return
+
+    TRACE["file"] = open(pathname, "a")
+    if TRACE["file"].tell() == 0:
+        TRACE["file"].write("[\n")
+    logging.info("Writing trace to %s", pathname)
+
+
+def close_trace():
+    if TRACE["file"] is not None:
+        TRACE["file"].close()
+        TRACE["file"] = None
+
+
+def begin_trace():
+    # Gives the document handled by the current thread a correlation ID
+    trace_id = None
+    if TRACE["file"] is not None:
+        trace_id = uuid.uuid4().hex
+    TRACE_CONTEXT.trace_id = trace_id
+
+    return trace_id
+
+
+def get_current_trace():
+    return getattr(TRACE_CONTEXT, "trace_id", None)
+
+
+def get_trace_id(name):
+    if TRACE["file"] is None:
+        return None
+
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        cursor.execute('SELECT trace_id FROM documents WHERE name=?',
+                       (name, ))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    return row[0]
+
+
+def trace_span(name, trace_id, start, end, args=None):
+    # One async span per step, viewers show a track per document
+    if TRACE["file"] is None or trace_id is None:
+        return
+
+    event = {
+        "cat": "document",
+        "name": name,
+        "id": trace_id,
+        "pid": os.getpid(),
+        "tid": threading.get_ident()
+    }
+    begin = dict(event, ph="b", ts=int(start * 1e6))
+    if args is not None:
+        begin["args"] = args
+    end = dict(event, ph="e", ts=int(end * 1e6))
+
+    with TRACE_LOCK:
+        if TRACE["file"] is None:
+            return
+        TRACE["file"].write(json.dumps(begin) + ",\n")
+        TRACE["file"].write(json.dumps(end) + ",\n")
+        TRACE["file"].flush()
+
+
+def record_stage(stage, start, name=None):
+    # Observes a stage of the document name which started at start
+    end = time.time()
+    observe("orchestrator_stage_seconds", {"stage": stage}, end - start)
+    if TRACE["file"] is not None and name is not None:
+        trace_span(stage, get_trace_id(name), start, end, {"document": name})
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+
+    return "{" + ",".join(
+        ['{}="{}"'.format(key, value) for key, value in labels]) + "}"
+
+
+def get_queue_depths():
+    depths = {}
+    for key, directory in METRICS["directories"].items():
+        try:
+            with os.scandir(directory) as entries:
+                depths[key] = len([
+                    entry for entry in entries
+                    if not entry.name.startswith(".")
+                ])
+        except OSError:
+            continue
+
+    return depths
+
+
+def get_ocr_throughput():
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        cursor.execute('''SELECT SUM(ocr_pages), SUM(ocr_time) FROM
+            (SELECT ocr_pages, ocr_time FROM documents
+            WHERE ocr_pages > 0 AND ocr_time > 0
+            ORDER BY rowid DESC LIMIT 100)''')
+        pages, seconds = cursor.fetchone()
+
+    if pages is None or not seconds:
+        return None
+
+    return pages / seconds
+
+
+def render_metrics():
+    # Prometheus text exposition format
+    lines = []
+
+    lines.append("# TYPE orchestrator_queue_depth gauge")
+    for key, depth in sorted(get_queue_depths().items()):
+        lines.append('orchestrator_queue_depth{{directory="{}"}} {}'.format(
+            key, depth))
+
+    throughput = get_ocr_throughput()
+    if throughput is not None:
+        lines.append("# TYPE orchestrator_ocr_pages_per_second gauge")
+        lines.append(
+            "orchestrator_ocr_pages_per_second {:.6f}".format(throughput))
+
+    with METRICS_LOCK:
+        counters = dict(METRICS["counters"])
+        histograms = {}
+        for key, histogram in METRICS["histograms"].items():
+            histograms[key] = {
+                "buckets": list(histogram["buckets"]),
+                "sum": histogram["sum"],
+                "count": histogram["count"]
+            }
+
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append("# TYPE {} counter".format(name))
+            typed.add(name)
+        lines.append("{}{} {}".format(name, format_labels(labels), value))
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        if name not in typed:
+            lines.append("# TYPE {} histogram".format(name))
+            typed.add(name)
+        for bound, count in zip(METRICS_BUCKETS, histogram["buckets"]):
+            if bound == float("inf"):
+                bound = "+Inf"
+            lines.append("{}_bucket{} {}".format(
+                name, format_labels(labels + (("le", bound), )), count))
+        lines.append("{}_sum{} {:.6f}".format(name, format_labels(labels),
+                                              histogram["sum"]))
+        lines.append("{}_count{} {}".format(name, format_labels(labels),
+                                            histogram["count"]))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format, *args)
+
+
+def open_metrics(dirs):
+    # Serves /metrics on METRICS_PORT if set, on localhost unless
+    # METRICS_ADDRESS says otherwise. METRICS_FILE is written by
+    # write_metrics() from the main loop.
+    for key in dirs:
+        if key not in ("config", "logs", "store"):
+            METRICS["directories"][key] = dirs[key]
+
+    port = os.environ.get("METRICS_PORT")
+    if port is None:
+        return None
+
+    address = os.environ.get("METRICS_ADDRESS", "127.0.0.1")
+    server = http.server.ThreadingHTTPServer((address, int(port)),
+                                             MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name="metrics",
+                              daemon=True)
+    thread.start()
+    logging.info("Serving metrics on %s port %s", address, port)
+
+    return server
+
+
+def write_metrics(pathname):
+    temporary = temporary_name(os.path.dirname(pathname) or ".")
+    with open(temporary, "w") as file:
+        file.write(render_metrics())
+    os.rename(temporary, pathname)
+
+
+def close_metrics(server):
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+def get_stat_key(stat):
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def get_cached_hash(stat):
+    # Files keep their inode, size and mtime as long as their content is
+    # unchanged, links into the store share the entry of their blob
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        result = cursor.execute(
+            '''SELECT hash FROM hashes
+            WHERE device=? AND inode=? AND size=? AND mtime_ns=?''',
+            get_stat_key(stat))
+        row = result.fetchone()
+
+    if row is None:
+        increment("orchestrator_hash_cache_total", {"result": "miss"})
+        return None
+
+    increment("orchestrator_hash_cache_total", {"result": "hit"})
+    return row[0]
+
+
+def save_cached_hash(stat, hash_value):
+    with transaction() as cursor:
+        cursor.execute(
+            '''INSERT OR REPLACE INTO hashes
+            (device, inode, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)''',
+            get_stat_key(stat) + (hash_value, ))
+
+
+def get_hash(filename):
+    stat = os.stat(filename)
+    hash_value = get_cached_hash(stat)
+    if hash_value is not None:
+        return hash_value
+
+    sha256_hash = hashlib.sha256()
+    with timed("hash"):
+        with open(filename, "rb") as file_handle:
+            # Empty files cannot be mapped
+            if stat.st_size > 0:
+                with mmap.mmap(file_handle.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    sha256_hash.update(data)
+    hash_value = sha256_hash.hexdigest()
+
+    # Do not remember files changed while reading them
+    if get_stat_key(os.stat(filename)) == get_stat_key(stat):
+        save_cached_hash(stat, hash_value)
+
+    return hash_value
+
+
+def get_hashes(pathnames):
+    # Hashes in up to HASH_WORKERS threads, hashlib releases the GIL while
+    # digesting
+    if HASH_WORKERS <= 1 or len(pathnames) <= 1:
+        return dict([(pathname, get_hash(pathname)) for pathname in pathnames])
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=HASH_WORKERS) as executor:
+        return dict(zip(pathnames, executor.map(get_hash, pathnames)))
+
+
+def temporary_name(directory):
+    # Hidden, so that neither the pipeline nor consumers pick it up
+    return os.path.join(directory,
+                        ".{}-{}.part".format(os.getpid(), uuid.uuid4().hex))
+
+
+def discard_temporaries(temporaries):
+    for temporary in temporaries:
+        try:
+            os.unlink(temporary)
+        except FileNotFoundError:
+            continue
+
+
+def tee_copy(source, destinations, renames=None, mode=0o777):
+    # Reads source once, writing all destinations in the same pass, and
+    # returns its SHA-256. Destinations are fsynced and get the metadata of
+    # source, the ones with an entry in renames are moved there afterwards.
+    sha256_hash = hashlib.sha256()
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    handles = []
+    copied = 0
+
+    try:
+        for destination in destinations:
+            handles.append(open(destination, "wb"))
+
+        with open(source, "rb") as file_handle:
+            length = file_handle.readinto(buffer)
+            while length > 0:
+                sha256_hash.update(view[:length])
+                for handle in handles:
+                    handle.write(view[:length])
+                copied += length * len(handles)
+                length = file_handle.readinto(buffer)
+
+        for handle in handles:
+            handle.flush()
+            os.fsync(handle.fileno())
+            handle.close()
+
+        for destination in destinations:
+            shutil.copystat(source, destination)
+            os.chmod(destination, mode)
+    except BaseException:
+        for handle in handles:
+            handle.close()
+        discard_temporaries(destinations)
+        raise
+
+    if renames is not None:
+        for destination, rename in zip(destinations, renames):
+            if rename is not None:
+                os.rename(destination, rename)
+
+    increment("orchestrator_bytes_copied_total", {}, copied)
+
+    return sha256_hash.hexdigest()
+
+
+def get_blob_path(store, hash_value):
+    return os.path.join(store, hash_value[:2], hash_value + ".pdf")
+
+
+def store_file(store, source):
+    # Copies source into the content addressed store, returns its hash.
+    # Files hashed before are not read again if their blob is present.
+    stat = os.stat(source)
+    hash_value = get_cached_hash(stat)
+    if hash_value is not None and os.path.isfile(
+            get_blob_path(store, hash_value)):
+        return hash_value
+
+    # Blobs are shared by hardlinks, nobody may change them in place
+    temporary = temporary_name(store)
+    with timed("hash"):
+        hash_value = tee_copy(source, [temporary], mode=0o444)
+
+    if get_stat_key(os.stat(source)) == get_stat_key(stat):
+        save_cached_hash(stat, hash_value)
+
+    blob = get_blob_path(store, hash_value)
+    if os.path.isfile(blob):
+        discard_temporaries([temporary])
+        return hash_value
+
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    os.rename(temporary, blob)
+    save_cached_hash(os.stat(blob), hash_value)
+
+    return hash_value
+
+
+def reflink_file(source, destination):
+    with open(source, "rb") as source_handle:
+        with open(destination, "wb") as destination_handle:
+            fcntl.ioctl(destination_handle.fileno(), FICLONE,
+                        source_handle.fileno())
+
+
+def copy_file(source, destination, mode=0o777):
+    # Reflinks source to destination, falling back to a copy. Either way
+    # writing to destination leaves source alone, so this is used for the
+    # folders other programs may write to.
+    temporary = temporary_name(os.path.dirname(destination))
+
+    with timed("copy", {"destination": destination}):
+        try:
+            reflink_file(source, temporary)
+            shutil.copystat(source, temporary)
+            os.chmod(temporary, mode)
+        except OSError as error:
+            logging.debug("Unable to reflink %s (%s), copying", destination,
+                          error)
+            discard_temporaries([temporary])
+            tee_copy(source, [temporary], mode=mode)
+
+        os.rename(temporary, destination)
+
+
+def link_file(source, destination):
+    # Hardlinks source to destination, copying with the same mode when
+    # crossing filesystems. Only for the read-only store and archives.
+    temporary = temporary_name(os.path.dirname(destination))
+
+    try:
+        with timed("copy", {"destination": destination}):
+            os.link(source, temporary)
+    except OSError as error:
+        logging.debug("Unable to link %s (%s), copying", destination, error)
+        copy_file(source, destination, os.stat(source).st_mode & 0o777)
+        return
+
+    os.rename(temporary, destination)
+
+
+def get_archive_path(archive, name, fallback=None):
+    # Names without a date are sharded by fallback (a timestamp) or now.
+    # Parsers may keep 2-digit years and 1-digit months, both are padded.
+    if ARCHIVE_LAYOUT == "flat":
+        return os.path.join(archive, name)
+
+    matches = ORCHESTRATED_REGEX.match(name)
+    if matches is not None:
+        year, month = int(matches.group(3)), int(matches.group(4))
+        if year < 100:
+            year += 2000
+    else:
+        when = datetime.fromtimestamp(fallback or time.time())
+        year, month = when.year, when.month
+
+    directory = os.path.join(archive, "{:04d}".format(year),
+                             "{:02d}".format(month))
+    os.makedirs(directory, exist_ok=True)
+
+    return os.path.join(directory, name)
+
+
+def archive_file(blob, archive, name):
+    # Links blob into its shard of archive, returns the path
+    pathname = get_archive_path(archive, name)
+    logging.info("Saving to %s", pathname)
+    link_file(blob, pathname)
+
+    return pathname
+
+
+def shard_archive_file(archive, filename):
+    source = os.path.join(archive, filename)
+    destination = get_archive_path(archive, filename,
+                                   os.stat(source).st_mtime)
+    if destination != source:
+        os.rename(source, destination)
+
+    return filename, destination
+
+
+def migrate_archive(archive, column):
+    # Moves the files at the top of archive into their shards with up to
+    # ARCHIVE_WORKERS renames in flight and records where they went
+    logging.info("Sharding %s", archive)
+    files = [
+        filename for filename in os.listdir(archive) if filename[0] != "."
+        and os.path.isfile(os.path.join(archive, filename))
+    ]
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=ARCHIVE_WORKERS) as executor:
+        moved = list(
+            executor.map(lambda filename: shard_archive_file(
+                archive, filename), files))
+
+    with transaction() as cursor:
+        cursor.executemany(
+            'UPDATE documents SET {}=? WHERE name=?'.format(column),
+            [(pathname, filename) for filename, pathname in moved])
+
+    logging.info("Sharded %i files of %s", len(moved), archive)
+
+
+def migrate_store(store, directories):
+    # Replaces byte-identical files in the given directories by links into
+    # the content addressed store
+    saved = 0
+
+    for directory in directories:
+        logging.info("Moving %s into %s", directory, store)
+        # Archives may be sharded into subdirectories
+        pathnames = []
+        for root, subdirectories, files in os.walk(directory):
+            pathnames.extend([
+                os.path.join(root, filename) for filename in files
+                if filename[0] != "."
+            ])
+        hashes = get_hashes(pathnames)
+
+        for pathname in pathnames:
+            blob = get_blob_path(store, hashes[pathname])
+            if not os.path.isfile(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                link_file(pathname, blob)
+                os.chmod(blob, 0o444)
+                continue
+
+            if os.path.samefile(pathname, blob):
+                continue
+
+            saved += os.path.getsize(pathname)
+            link_file(blob, pathname)
+
+    logging.info("Store migration done, saved %i bytes", saved)
+
+
+def open_database(config):
+    global DB_CONNECTION
+
+    # The connection is shared by the ingestion workers, guarded by DB_LOCK.
+    # Transactions are managed explicitly by transaction().
+    connection = sqlite3.connect(os.path.join(config, 'documents.db'),
+                                 check_same_thread=False,
+                                 isolation_level=None,
+                                 cached_statements=256)
+
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('PRAGMA busy_timeout=5000')
 
     DB_CONNECTION = connection
 
+    migrate_database()
+
     return connection
 
 
+def migrate_database():
+    with transaction() as cursor:
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+
+        for migration in MIGRATIONS[version:]:
+            version += 1
+            logging.info("Migrating database to version %i", version)
+            for statement in migration:
+                cursor.execute(statement)
+
+        # PRAGMA does not support parameters
+        cursor.execute('PRAGMA user_version={:d}'.format(version))
+
+
 def get_database():
     global DB_CONNECTION
     return DB_CONNECTION
 
 
 def close_database(connection):
+    connection.execute('PRAGMA optimize')
     connection.close()
 
 
-def is_document_known(document_hash):
-    connection = get_database()
-    cursor = connection.cursor()
-    known = False
+@contextlib.contextmanager
+def transaction():
+    # Unit of work: the outermost transaction commits once at its end,
+    # nested ones are savepoints that roll back on their own on exceptions
+    global DB_DEPTH
 
-    result = cursor.execute(
-        'SELECT name FROM documents WHERE hash_original=? OR hash_ocr=?',
-        (document_hash, document_hash))
-    for row in result:
-        known = True
-        logging.debug("Documents with hash %s: %s", document_hash, str(row))
-        break
+    start = time.time()
+    with DB_LOCK:
+        connection = get_database()
+        savepoint = 'level{:d}'.format(DB_DEPTH)
 
-    connection.commit()
+        if DB_DEPTH == 0:
+            observe("orchestrator_db_seconds", {"operation": "lock_wait"},
+                    time.time() - start)
+            start = time.time()
+            connection.execute('BEGIN IMMEDIATE')
+        else:
+            connection.execute('SAVEPOINT ' + savepoint)
+        DB_DEPTH += 1
 
-    return known
+        try:
+            yield connection.cursor()
+        except BaseException:
+            DB_DEPTH -= 1
+            if DB_DEPTH == 0:
+                connection.execute('ROLLBACK')
+            else:
+                connection.execute('ROLLBACK TO ' + savepoint)
+                connection.execute('RELEASE ' + savepoint)
+            raise
 
+        DB_DEPTH -= 1
+        if DB_DEPTH == 0:
+            connection.execute('COMMIT')
+            observe("orchestrator_db_seconds", {"operation": "transaction"},
+                    time.time() - start)
+            trace_span("db", get_current_trace(), start, time.time())
+        else:
+            connection.execute('RELEASE ' + savepoint)
 
-def add_document(name_original, name, hash_original, status):
-    connection = get_database()
-    cursor = connection.cursor()
 
-    try:
+def is_document_known(document_hash):
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        known = False
+
+        result = cursor.execute(
+            'SELECT name FROM documents WHERE hash_original=? OR hash_ocr=?',
+            (document_hash, document_hash))
+        for row in result:
+            known = True
+            logging.debug("Documents with hash %s: %s", document_hash,
+                          str(row))
+            break
+
+        return known
+
+
+def seed_document_index(archive_raw):
+    # One-time migration from the index being the size of archive_raw
+    with transaction() as cursor:
+        result = cursor.execute(
+            'SELECT value FROM sequences WHERE name="documents"')
+        if result.fetchone() is not None:
+            return
+
+        files = [name for name in os.listdir(archive_raw) if name[0] != "."]
+        index = len(files)
+        for filename in files:
+            existing = get_orchestrated_index(filename)
+            if existing is not None and existing >= index:
+                index = existing + 1
+
+        logging.info("Starting document index at %i", index)
         cursor.execute(
-            '''INSERT INTO documents
-                (name_original, hash_original, name, status, last_update)
-                VALUES (?, ?, ?, ?, datetime("now"))''',
-            (name_original, hash_original, name, status))
+            'INSERT INTO sequences (name, value) VALUES ("documents", ?)',
+            (index, ))
+
+
+def add_document(name_original, get_name, hash_original, status):
+    # Hands out the next index and inserts the document named get_name(index)
+    # in one transaction. Returns the name, None if already present.
+    try:
+        with transaction() as cursor:
+            cursor.execute('''UPDATE sequences SET value=value+1
+                WHERE name="documents"''')
+            result = cursor.execute(
+                'SELECT value - 1 FROM sequences WHERE name="documents"')
+            name = get_name(result.fetchone()[0])
+
+            cursor.execute(
+                '''INSERT INTO documents
+                    (name_original, hash_original, name, status, last_update,
+                    trace_id)
+                    VALUES (?, ?, ?, ?, datetime("now"), ?)''',
+                (name_original, hash_original, name, status,
+                 get_current_trace()))
     except sqlite3.IntegrityError as error:
         logging.error("add_document failed with %s", ' '.join(error.args))
         # Document already present in database
-        return False
+        return None
 
-    connection.commit()
-    return True
+    return name
 
 
 def add_ocr_hash(name, hash_ocr):
-    connection = get_database()
-    cursor = connection.cursor()
-    cursor.execute(
-        '''INSERT OR IGNORE INTO documents
-        (name, status, last_update)
-        VALUES (?, ?, datetime("now"))''', (name, "new"))
-    logging.debug("Updating %s with %s", name, hash_ocr)
-    cursor.execute(
-        '''UPDATE documents SET
-        hash_ocr=?, status=?, last_update=datetime("now") WHERE name=?''',
-        (hash_ocr, "ocred", name))
-    connection.commit()
+    with transaction() as cursor:
+        cursor.execute(
+            '''INSERT OR IGNORE INTO documents
+            (name, status, last_update)
+            VALUES (?, ?, datetime("now"))''', (name, "new"))
+        logging.debug("Updating %s with %s", name, hash_ocr)
+        cursor.execute(
+            '''UPDATE documents SET
+            hash_ocr=?, status=?, last_update=datetime("now"),
+            time_ocred=datetime("now") WHERE name=?''',
+            (hash_ocr, "ocred", name))
+        journal_document(name, "ocred")
+        PENDING_CONSUMPTION.add(name)
+
+
+def load_pending_consumption():
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        result = cursor.execute(
+            'SELECT name FROM documents WHERE status="ocred"')
+
+        PENDING_CONSUMPTION.clear()
+        for row in result:
+            PENDING_CONSUMPTION.add(row[0])
+
+        logging.debug("%i documents waiting for consumption",
+                      len(PENDING_CONSUMPTION))
+
+
+def mark_consumed(names):
+    with transaction() as cursor:
+        cursor.executemany(
+            '''UPDATE documents SET
+            status="consumed", last_update=datetime("now"),
+            time_consumed=datetime("now"),
+            consumption_latency=(julianday("now") -
+                julianday(time_ocred)) * 86400
+            WHERE name=?''', [(name, ) for name in names])
+        cursor.executemany(
+            '''INSERT INTO journal (name, state, timestamp)
+            VALUES (?, "consumed", datetime("now"))''',
+            [(name, ) for name in names])
+        PENDING_CONSUMPTION.difference_update(names)
+
+        for name in names:
+            cursor.execute(
+                '''SELECT consumption_latency, trace_id FROM documents
+                WHERE name=?''', (name, ))
+            row = cursor.fetchone()
+            if row is not None and row[0] is not None:
+                observe("orchestrator_stage_seconds",
+                        {"stage": "consumption"}, row[0])
+                trace_span("consumption", row[1],
+                           time.time() - row[0], time.time(),
+                           {"document": name})
 
 
 def add_ocr_parameters(filename, values):
-    connection = get_database()
-    cursor = connection.cursor()
-    cursor.execute(
-        '''UPDATE documents SET
-        ocr_pages=?, ocr_time=?, ocr_errors=?, ocr_warnings=?,
-        ocr_chars_total=?, ocr_chars_wrong=? WHERE name=?''',
-        (values["Pages"], values["Time"], values["Errors"], values["Warnings"],
-         values["Chars_Total"], values["Chars_Wrong"], filename))
-    connection.commit()
+    with transaction() as cursor:
+        cursor.execute(
+            '''UPDATE documents SET
+            ocr_pages=?, ocr_time=?, ocr_errors=?, ocr_warnings=?,
+            ocr_chars_total=?, ocr_chars_wrong=? WHERE name=?''',
+            (values["Pages"], values["Time"], values["Errors"],
+             values["Warnings"], values["Chars_Total"], values["Chars_Wrong"],
+             filename))
+
+
+def set_archive_paths(name, raw=None, ocr=None):
+    with transaction() as cursor:
+        if raw is not None:
+            cursor.execute('UPDATE documents SET archive_raw=? WHERE name=?',
+                           (raw, name))
+        if ocr is not None:
+            cursor.execute('UPDATE documents SET archive_ocr=? WHERE name=?',
+                           (ocr, name))
+
+
+def set_document_pages(name, pages):
+    with transaction() as cursor:
+        cursor.execute('UPDATE documents SET pages=? WHERE name=?',
+                       (pages, name))
 
 
 def update_status(name, status):
-    connection = get_database()
-    cursor = connection.cursor()
-    cursor.execute(
-        '''UPDATE documents SET
-        status=?, last_update=datetime("now") WHERE name=?''', (status, name))
-    connection.commit()
+    with transaction() as cursor:
+        cursor.execute(
+            '''UPDATE documents SET
+            status=?, last_update=datetime("now") WHERE name=?''',
+            (status, name))
+        journal_document(name, status)
 
 
 def update_status_by_original_hash(hash_original, status):
-    connection = get_database()
-    cursor = connection.cursor()
-    cursor.execute(
-        '''UPDATE documents SET
-        status=?, last_update=datetime("now") WHERE hash_original=?''',
-        (status, hash_original))
-    connection.commit()
+    with transaction() as cursor:
+        cursor.execute(
+            '''UPDATE documents SET
+            status=?, last_update=datetime("now") WHERE hash_original=?''',
+            (status, hash_original))
 
 
 def save_log(name, log):
-    connection = get_database()
-    cursor = connection.cursor()
-    cursor.execute(
-        '''INSERT INTO document_logs
-        (name, timestamp, log) VALUES (?, datetime("now"), ?)''', (name, log))
-    connection.commit()
+    with transaction() as cursor:
+        cursor.execute(
+            '''INSERT INTO document_logs
+            (name, timestamp, log) VALUES (?, datetime("now"), ?)''',
+            (name, log))
+
+
+def journal_document(name, state, source=None, signature=None):
+    with transaction() as cursor:
+        cursor.execute(
+            '''INSERT INTO journal
+            (name, state, timestamp, source, signature)
+            VALUES (?, ?, datetime("now"), ?, ?)''',
+            (name, state, source, signature))
+
+
+def get_file_signature(pathname):
+    # Input files are only ever renamed into place, a file with the same
+    # size, mtime and inode is the one that has been ingested before
+    return "{:d}:{:d}:{:d}".format(*sample_file(pathname))
+
+
+def find_journaled_file(pathname, signature):
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        result = cursor.execute(
+            '''SELECT name FROM journal
+            WHERE source=? AND signature=? LIMIT 1''',
+            (pathname, signature))
+        row = result.fetchone()
+
+        if row is None:
+            return None
+        return row[0]
+
+
+def get_unfinished_documents():
+    # Returns (name, state, hash_original) of the documents whose last
+    # transition is resumable
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        result = cursor.execute(
+            '''SELECT journal.name, journal.state, documents.hash_original
+            FROM journal JOIN documents ON documents.name=journal.name
+            WHERE journal.rowid IN
+                (SELECT MAX(rowid) FROM journal GROUP BY name)
+            AND journal.state IN ({})'''.format(",".join(
+                ["?"] * len(JOURNAL_RESUMABLE))), JOURNAL_RESUMABLE)
+
+        return result.fetchall()
 
 
 def read_prefix(directory, filename):
@@ -168,40 +1228,122 @@ def read_prefix(directory, filename):
     return prefix.strip()
 
 
-def get_index(directory):
-    files = os.listdir(directory)
-    return len(files)
+def sample_file(pathname):
+    stat = os.stat(pathname)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
 
 
 def is_file_stable(pathname):
-    if (time.time() - os.path.getmtime(pathname)) < 120:
-        return False
+    # Files are tracked from the first time they are looked at and sampled
+    # once per loop tick by update_stability() until they settle
+    entry = STABILITY.get(pathname)
+    if entry is None:
+        try:
+            sample = sample_file(pathname)
+        except FileNotFoundError:
+            return False
+
+        entry = {
+            "sample": sample,
+            "count": 1,
+            "first_sample": time.time(),
+            "last_sample": time.time(),
+            "state": "pending"
+        }
+        if STABLE_SAMPLES <= 1:
+            entry["state"] = "stable"
+        STABILITY[pathname] = entry
+        logging.debug("Tracking %s for stability", pathname)
+
+    return entry["state"] == "stable"
+
+
+def mark_file_closed(pathname):
+    # The writer closed (or renamed) the file, no need to wait any longer
+    try:
+        sample = sample_file(pathname)
+    except FileNotFoundError:
+        STABILITY.pop(pathname, None)
+        return
 
-    return True
+    now = time.time()
+    first_sample = now
+    if pathname in STABILITY:
+        first_sample = STABILITY[pathname]["first_sample"]
+    observe("orchestrator_stage_seconds", {"stage": "stabilize"},
+            now - first_sample)
+
+    STABILITY[pathname] = {
+        "sample": sample,
+        "count": STABLE_SAMPLES,
+        "first_sample": first_sample,
+        "last_sample": now,
+        "state": "stable"
+    }
 
 
-def wait_for_file_to_stabilize(pathname):
-    if os.path.getmtime(pathname) > time.time():
-        logging.error("Time mismatch, please sync your clocks")
-        return
+def recheck_stable_files(directories):
+    # Stable files are only looked at again when their directory is due,
+    # files that are gone are forgotten and changed ones wait again
+    for pathname in list(STABILITY):
+        entry = STABILITY[pathname]
+        if entry["state"] != "stable" or \
+                os.path.dirname(pathname) not in directories:
+            continue
+
+        try:
+            sample = sample_file(pathname)
+        except FileNotFoundError:
+            del STABILITY[pathname]
+            continue
 
-    while not is_file_stable(pathname):
-        logging.info("Waiting for file %s to stabilize. (%i vs. %i)", pathname,
-                     time.time(), os.path.getmtime(pathname))
-        time.sleep(30)
+        if sample != entry["sample"]:
+            logging.info("%s changed again, waiting for it to settle",
+                         pathname)
+            entry["sample"] = sample
+            entry["count"] = 1
+            entry["last_sample"] = time.time()
+            entry["state"] = "pending"
+
+
+def update_stability():
+    # Samples all pending files, returns the directories in which files have
+    # become stable
+    settled = set()
+    now = time.time()
+
+    for pathname in list(STABILITY):
+        entry = STABILITY[pathname]
+        if entry["state"] == "stable" or \
+                (now - entry["last_sample"]) < STABLE_INTERVAL:
+            continue
+
+        try:
+            sample = sample_file(pathname)
+        except FileNotFoundError:
+            del STABILITY[pathname]
+            continue
 
+        entry["last_sample"] = now
+        if sample != entry["sample"]:
+            entry["sample"] = sample
+            entry["count"] = 1
+            entry["state"] = "pending"
+            continue
 
-def parse_app_filename(filename, prefix, index, suffix):
-    # Format: scan_2021-01-08-08.43-37.pdf
-    # Format: scan_2020-11-08-06.23-49 39.pdf
-    regex_app = r"^[a-z]*[\.\-_]{1}([0-9]{2,4})[\.\-_]{1}([0-9]{1,2})" + \
-            r"[\.\-_]{1}([0-9]{1,2})[\.\-_]{1}([0-9]{1,2})[\.\-_]{1}" + \
-            r"([0-9]{1,2})[\.\-_]{1}([0-9]{1,2}).*\.pdf$"
+        entry["count"] += 1
+        if entry["state"] == "pending" and entry["count"] >= STABLE_SAMPLES:
+            logging.debug("%s is stable after %i samples", pathname,
+                          entry["count"])
+            entry["state"] = "stable"
+            settled.add(os.path.dirname(pathname))
+            observe("orchestrator_stage_seconds", {"stage": "stabilize"},
+                    now - entry["first_sample"])
+
+    return settled
 
-    matches = re.match(regex_app, filename, re.IGNORECASE)
-    if matches is None:
-        return None
 
+def build_scanned_name(matches, filename, prefix, index, suffix):
     filename_no_ext, file_extension = os.path.splitext(filename)
 
     name_list = [
@@ -219,465 +1361,2375 @@ def parse_app_filename(filename, prefix, index, suffix):
     return name
 
 
-def parse_adf_filename(filename, prefix, index, suffix):
-    regex_scanner = r"^([0-9]{4})([0-9]{2})([0-9]{2})_([0-9]{2})([0-9]{2})" + \
-            r"([0-9]{2})_[0-9a-zA-Z]+_[0-9]+\.pdf$"
-    matches = re.match(regex_scanner, filename, re.IGNORECASE)
-    if matches is None:
-        return None
-
+def build_canon_name(matches, filename, prefix, index, suffix):
     filename_no_ext, file_extension = os.path.splitext(filename)
 
+    now = datetime.now()
     name_list = [
-        str(prefix), "{:05d}".format(index),
+        str(None), "{:05d}".format(index),
         matches.group(1),
         matches.group(2),
         matches.group(3),
-        matches.group(4),
-        matches.group(5),
-        matches.group(6),
-        str(suffix), filename_no_ext
+        now.strftime("%H"),
+        now.strftime("%M"),
+        now.strftime("%S"),
+        str(suffix),
+        matches.group(4), filename_no_ext
     ]
     name = "-".join(name_list) + ".pdf"
 
     return name
 
 
-def parse_canon_filename(filename, prefix, index, suffix):
-    # IMG_20210202_0001.pdf
-    regex_canon = r"IMG_([0-9]{4})([0-9]{2})([0-9]{2})_([0-9]+)[0-9\(\)]*.pdf$"
-    matches = re.match(regex_canon, filename, re.IGNORECASE)
-    if matches is None:
-        return None
-
-    filename_no_ext, file_extension = os.path.splitext(filename)
-
+def build_email_name(matches, filename, prefix, index, suffix):
     now = datetime.now()
     name_list = [
         str(None), "{:05d}".format(index),
-        matches.group(1),
-        matches.group(2),
-        matches.group(3),
+        "{:04d}".format(int(matches.group(1))),
+        "{:02d}".format(int(matches.group(2))),
+        "{:02d}".format(int(matches.group(3))),
         now.strftime("%H"),
         now.strftime("%M"),
         now.strftime("%S"),
         str(suffix),
-        matches.group(4), filename_no_ext
+        matches.group(4)
+    ]
+
+    name = "-".join(name_list) + ".pdf"
+
+    return name
+
+
+def build_orchestrated_name(matches, filename, prefix, index, suffix):
+    name_list = [
+        matches.group(1), "{:05d}".format(index),
+        matches.group(3),
+        matches.group(4),
+        matches.group(5),
+        matches.group(6),
+        matches.group(7),
+        matches.group(8),
+        matches.group(9)
     ]
+
+    if len(matches.group(10)) > 0:
+        name_list.append(matches.group(10))
+
     name = "-".join(name_list) + ".pdf"
 
-    return name
+    return name
+
+
+def build_configured_name(matches, filename, prefix, index, suffix):
+    # Parsers from config/PARSERS name their groups, time defaults to now
+    filename_no_ext, file_extension = os.path.splitext(filename)
+    values = matches.groupdict()
+
+    now = datetime.now()
+    name_list = [
+        str(prefix), "{:05d}".format(index),
+        "{:04d}".format(int(values["year"])),
+        "{:02d}".format(int(values["month"])),
+        "{:02d}".format(int(values["day"])),
+        values.get("hour") or now.strftime("%H"),
+        values.get("minute") or now.strftime("%M"),
+        values.get("second") or now.strftime("%S"),
+        str(suffix), filename_no_ext
+    ]
+    name = "-".join(name_list) + ".pdf"
+
+    return name
+
+
+def get_filename_parser(name, regex, target, build):
+    return {
+        "name": name,
+        "regex": re.compile(regex, re.IGNORECASE),
+        "target": target,
+        "build": build
+    }
+
+
+def load_filename_parsers(config):
+    # Built-in parsers in the order they are tried, followed by the ones in
+    # config/PARSERS and the heuristic as a last resort
+    parsers = [
+        # Format: scan_2021-01-08-08.43-37.pdf
+        # Format: scan_2020-11-08-06.23-49 39.pdf
+        get_filename_parser(
+            "app", r"^[a-z]*[\.\-_]{1}([0-9]{2,4})[\.\-_]{1}([0-9]{1,2})" +
+            r"[\.\-_]{1}([0-9]{1,2})[\.\-_]{1}([0-9]{1,2})[\.\-_]{1}" +
+            r"([0-9]{1,2})[\.\-_]{1}([0-9]{1,2}).*\.pdf$", "filename",
+            build_scanned_name),
+        get_filename_parser(
+            "adf", r"^([0-9]{4})([0-9]{2})([0-9]{2})_([0-9]{2})([0-9]{2})" +
+            r"([0-9]{2})_[0-9a-zA-Z]+_[0-9]+\.pdf$", "filename",
+            build_scanned_name),
+        # Format: IMG_20210202_0001.pdf
+        get_filename_parser(
+            "canon",
+            r"IMG_([0-9]{4})([0-9]{2})([0-9]{2})_([0-9]+)[0-9\(\)]*.pdf$",
+            "filename", build_canon_name),
+        # Format: box00001-00008-2018-01-01-00-09-55-scanner.pdf
+        # Format: None-00443-2020-11-08-08-37-37-mobile-scan_2020-11-08-06.23-49 39.pdf
+        get_filename_parser("orchestrated", REGEX_ORCHESTRATOR, "stem",
+                            build_orchestrated_name),
+        # Format: 2021-1-18--VERTRAGSRELEVANTE_DOKUMENTE_dat20200928_id909128141.pdf
+        get_filename_parser("email",
+                            r"([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})--(.*)$",
+                            "stem", build_email_name),
+    ]
+
+    # One parser per line, "name: regex" with named groups year, month, day
+    # and optionally hour, minute and second, matched against the filename
+    path = os.path.join(config, "PARSERS")
+    if os.path.isfile(path):
+        with open(path, "r") as file_handle:
+            for line in file_handle:
+                line = line.strip()
+                if len(line) == 0 or line[0] == "#":
+                    continue
+
+                if ":" not in line:
+                    logging.error("Ignoring filename parser line %s", line)
+                    continue
+
+                name, regex = line.split(":", 1)
+                try:
+                    parser = get_filename_parser(name.strip(), regex.strip(),
+                                                 "filename",
+                                                 build_configured_name)
+                except re.error as error:
+                    logging.error("Ignoring filename parser %s: %s", name,
+                                  error)
+                    continue
+
+                if "year" not in parser["regex"].groupindex or \
+                        "month" not in parser["regex"].groupindex or \
+                        "day" not in parser["regex"].groupindex:
+                    logging.error(
+                        "Ignoring filename parser %s: year, month and day " +
+                        "groups are required", name)
+                    continue
+
+                logging.info("Loaded filename parser %s", parser["name"])
+                parsers.append(parser)
+
+    parsers.append(
+        get_filename_parser(
+            "heuristic",
+            r"([0-9]{4})[\-\._]{1}([0-9]{2})[\-\._]{1}([0-9]{2})" +
+            r"[\-\._]{1}([0-9]{2})[\-\._]{1}([0-9]{2})[\-\._]{1}([0-9]{2})" +
+            r".*\.pdf$", "filename", build_scanned_name))
+
+    FILENAME_PARSERS[:] = parsers
+
+
+def match_filename(filename):
+    # Returns the first parser matching filename and its match
+    filename_no_ext, file_extension = os.path.splitext(filename)
+
+    for parser in FILENAME_PARSERS:
+        if parser["target"] == "stem":
+            matches = parser["regex"].match(filename_no_ext)
+        else:
+            matches = parser["regex"].match(filename)
+
+        if matches is not None:
+            # Counted by the ingestion workers, so through the metrics
+            increment("orchestrator_parser_hits_total",
+                      {"parser": parser["name"]})
+            return parser, matches
+
+    return None, None
+
+
+def get_parser_hits():
+    with METRICS_LOCK:
+        counters = dict(METRICS["counters"])
+
+    hits = []
+    for parser in FILENAME_PARSERS:
+        labels = (("parser", parser["name"]), )
+        count = counters.get(("orchestrator_parser_hits_total", labels), 0)
+        hits.append("{}={}".format(parser["name"], count))
+
+    return ", ".join(hits)
+
+
+def get_orchestrated_index(filename):
+    filename_no_ext, file_extension = os.path.splitext(filename)
+
+    matches = ORCHESTRATED_REGEX.match(filename_no_ext)
+
+    if matches is None:
+        return None
+
+    return int(matches.group(2))
+
+
+def get_document_name(parser, matches, filename, prefix, index, suffix):
+    if parser is not None:
+        return parser["build"](matches, filename, prefix, index, suffix)
+
+    # Just make up a name as we go
+    filename_no_ext, file_extension = os.path.splitext(filename)
+
+    now = datetime.now()
+    name_list = [
+        str(prefix), "{:05d}".format(index),
+        now.strftime("%Y"),
+        now.strftime("%m"),
+        now.strftime("%d"),
+        now.strftime("%H"),
+        now.strftime("%M"),
+        now.strftime("%S"),
+        str(suffix), filename_no_ext
+    ]
+    name = "-".join(name_list) + ".pdf"
+
+    return name
+
+
+def process_scanner_file(directory,
+                         filename,
+                         prefix,
+                         ocr_in,
+                         consumption,
+                         archive_raw,
+                         archive_ocred,
+                         store,
+                         fail,
+                         strict=True,
+                         suffix=None,
+                         force_ocr=True,
+                         mirror=None,
+                         repair=None):
+    name = None
+    pathname = os.path.join(directory, filename)
+
+    logging.info(
+        "Handling scanned file %s (strict=%s, suffix=%s, force_ocr=%s)",
+        filename, strict, suffix, force_ocr)
+
+    # Spans of this thread belong to the document from now on
+    trace_id = begin_trace()
+    entry = STABILITY.get(pathname)
+    if entry is not None:
+        trace_span("stabilize", trace_id, entry["first_sample"], time.time(),
+                   {"filename": filename})
+
+    parser, matches = match_filename(filename)
+    if parser is None and strict:
+        logging.error("Unable to parse %s, moving to %s!", filename, fail)
+
+        shutil.move(pathname, os.path.join(fail, filename))
+        os.chmod(os.path.join(fail, filename), 0o777)
+
+        # Mirror all ingress files for testing
+        mirror_file(mirror, os.path.join(fail, filename), filename)
+        return
+
+    # Files left behind by an interrupted run are not hashed again
+    signature = get_file_signature(pathname)
+    known = find_journaled_file(pathname, signature)
+    if known is not None:
+        logging.info("%s has already been ingested as %s, deleting",
+                     filename, known)
+        os.unlink(pathname)
+        return
+
+    # Read the input once into the store, everything else links to it
+    hash_value = store_file(store, pathname)
+    blob = get_blob_path(store, hash_value)
+
+    needs_ocr = force_ocr or document_needs_ocr(blob, hash_value)
+
+    # Fingerprint documents headed for OCR outside of the transaction
+    similarity = None
+    pages = None
+    damage = None
+    if needs_ocr:
+        pages, damage = validate_pdf(blob)
+        if DUPLICATE_ACTION != "off":
+            similarity = get_similarity(blob)
+
+    # Look for near duplicates before the transaction holds the database
+    duplicate = None
+    if similarity is not None:
+        duplicate = find_near_duplicate(similarity)
+
+    # Mirror all ingress files for testing
+    mirror_file(mirror, blob, filename)
+
+    # Registration is one unit of work, the index is handed out in the same
+    # transaction. Files are only touched after the commit, the journal
+    # lets recover_documents() finish the job after a crash.
+    with transaction():
+        if is_document_known(hash_value):
+            name = None
+        else:
+            name = add_document(
+                filename, lambda index: get_document_name(
+                    parser, matches, filename, prefix, index, suffix),
+                hash_value, "new")
+
+        if name is not None:
+            journal_document(name, "ingested", pathname, signature)
+            set_document_pages(name, pages)
+
+            if similarity is not None:
+                save_similarity(name, similarity)
+
+            if duplicate is not None:
+                save_log(name, "near duplicate of " + duplicate)
+
+    if name is None:
+        logging.error("%s already present in database, deleting", filename)
+        os.unlink(pathname)
+        return
+
+    logging.info("Created input file filename %s", name)
+
+    # Link into the permanent archive
+    archived = archive_file(blob, archive_raw, name)
+    with transaction():
+        set_archive_paths(name, raw=archived)
+        journal_document(name, "archived")
+
+    if duplicate is not None:
+        logging.warning("%s is a near duplicate of %s", name, duplicate)
+
+        if DUPLICATE_ACTION == "skip":
+            update_status(name, "duplicate")
+            os.unlink(pathname)
+            return
+
+    if not needs_ocr:
+        # Skip OCR, text is already there
+        logging.info("%s does not need OCR, bypassing queue", filename)
+        logging.info("Saving to %s", os.path.join(consumption, name))
+        copy_file(blob, os.path.join(consumption, name))
+
+        archived = archive_file(blob, archive_ocred, name)
+
+        # Update database, the content has not been changed
+        with transaction():
+            add_ocr_hash(name, hash_value)
+            set_archive_paths(name, ocr=archived)
+    elif damage is not None and repair is not None:
+        # Have it repaired before it takes an OCR slot
+        logging.warning("%s is damaged (%s), saving to %s", name, damage,
+                        os.path.join(repair, name))
+        copy_file(blob, os.path.join(repair, name))
+        with transaction():
+            journal_document(name, "repairing")
+            save_log(name, "damaged: " + damage)
+    else:
+        # Copy to OCR hot folder once the document is registered
+        logging.info("Saving to %s", os.path.join(ocr_in, name))
+        copy_file(blob, os.path.join(ocr_in, name))
+        journal_document(name, "queued")
+
+    # Remove input file
+    os.unlink(pathname)
+
+
+def preserve_hfl(filename, hfl):
+    logging.debug("preserve_hfl(%s, %s)", filename, hfl)
+
+    real_hfl = os.path.basename(hfl)
+    filename, file_extension = os.path.splitext(filename)
+
+    preserve_name = filename + "_" + real_hfl
+    logging.debug("preserve_name = %s", preserve_name)
+
+    shutil.move(hfl, os.path.join("logs", preserve_name))
+    os.chmod(os.path.join("logs", preserve_name), 0o777)
+
+    logging.debug("preserve done")
+
+
+def store_ocred_file(pathname, filename, values, consumption, archive_ocred,
+                     store):
+    # Runs in the main thread, which continues the trace of the document
+    TRACE_CONTEXT.trace_id = get_trace_id(filename)
+
+    try:
+        hash_ocr = store_file(store, pathname)
+        blob = get_blob_path(store, hash_ocr)
+
+        logging.info("Saving to %s", os.path.join(consumption, filename))
+        copy_file(blob, os.path.join(consumption, filename))
+
+        archived = archive_file(blob, archive_ocred, filename)
+
+        # Update database
+        with transaction():
+            add_ocr_hash(filename, hash_ocr)
+            set_archive_paths(filename, ocr=archived)
+            if values is not None:
+                add_ocr_parameters(filename, values)
+    finally:
+        TRACE_CONTEXT.trace_id = None
+
+
+def process_ocred_file(directory, filename, consumption, archive_ocred,
+                       store):
+    # The OCR Log is written after the PDF, come back once it is complete
+    hot_folder_log = glob.glob(os.path.join(directory, "Hot Folder Log*.txt"))
+    if len(hot_folder_log) < 1:
+        logging.debug("Waiting for OCR Log of %s to appear", filename)
+        return False
+
+    for file in hot_folder_log:
+        if not is_file_stable(file):
+            return False
+
+    logging.info("Handling OCRed file %s", filename)
+
+    # Read OCR parameters
+    values = None
+    if len(hot_folder_log) > 1:
+        logging.error(
+            "Found %i Hot Folder Log Files: %s. Deleting all, parsing none.",
+            len(hot_folder_log), str(hot_folder_log))
+
+    if len(hot_folder_log) == 1:
+        logging.debug("Parsing %s", hot_folder_log[0])
+        values = parse_ocr_log(directory, os.path.basename(hot_folder_log[0]))
+
+    store_ocred_file(os.path.join(directory, filename), filename, values,
+                     consumption, archive_ocred, store)
+
+    for file in hot_folder_log:
+        preserve_hfl(filename, file)
+
+    # Remove input file
+    os.unlink(os.path.join(directory, filename))
+
+    return True
+
+
+def check_consumption(directory):
+    # Diffs one snapshot of the consumption directory against the documents
+    # known to be waiting there
+    with DB_LOCK:
+        pending = set(PENDING_CONSUMPTION)
+
+    if len(pending) == 0:
+        return
+
+    present = set()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            present.add(entry.name)
+
+    consumed = pending - present
+    for filename in consumed:
+        logging.info("%s appears to have been consumed", filename)
+
+    if len(consumed) > 0:
+        mark_consumed(consumed)
+
+
+def serve_ocr_queue(directory, filename, ocr_in, exclusive=True):
+    if exclusive and len(os.listdir(ocr_in)) > 0:
+        return False
+
+    logging.info("Starting OCR of %s", filename)
+    try:
+        record_stage("queue_wait",
+                     os.stat(os.path.join(directory, filename)).st_ctime,
+                     filename)
+    except FileNotFoundError:
+        return False
+    shutil.move(os.path.join(directory, filename),
+                os.path.join(ocr_in, filename))
+    os.chmod(os.path.join(ocr_in, filename), 0o777)
+
+    update_status(filename, "ocring")
+
+    return True
+
+
+def get_ocr_section():
+    return {
+        "Pages": None,
+        "Time": None,
+        "Errors": None,
+        "Warnings": None,
+        "Chars_Total": None,
+        "Chars_Wrong": None,
+        "Error_Message": None,
+        "Successful": True,
+    }
+
+
+def parse_ocr_log_sections(path, max_sections=None):
+    # Streams the log and returns one result per document it covers. With
+    # max_sections, statistics after that many sections are skipped, error
+    # lines still fail the last section wherever they are.
+    sections = []
+    section = None
+    seen = set()
+    full = False
+
+    with open(path, encoding='utf-16le') as file:
+        for line in file:
+            line = line.lstrip("\ufeff")
+
+            field = None
+            for prefixes, key, regex in OCR_LOG_FIELDS:
+                if line.startswith(prefixes):
+                    field = key
+                    break
+
+            if field is None:
+                if "Fehler: " not in line and "Error: " not in line:
+                    continue
+                field = "Reason"
+                regex = OCR_LOG_REASON
+
+            if full and field != "Reason":
+                continue
+
+            matches = regex.match(line)
+            if matches is None:
+                continue
+
+            # A section ends with its last statistic or when one repeats.
+            # Failed documents lack some statistics but start with their
+            # error, so an error after statistics begins the next section.
+            boundary = section is None or field in seen or (
+                len(seen) > 0 and
+                (field == "Reason" or len(seen) == len(OCR_LOG_FIELDS)))
+            if boundary and max_sections is not None and \
+                    len(sections) >= max_sections:
+                full = True
+                if field != "Reason":
+                    continue
+            if boundary and not full:
+                section = get_ocr_section()
+                sections.append(section)
+                seen = set()
+            if field != "Reason":
+                seen.add(field)
+
+            if field == "Pages":
+                section["Pages"] = int(matches.group(1))
+            elif field == "Time":
+                section["Time"] = int(matches.group(1)) * 3600 + int(
+                    matches.group(2)) * 60 + int(matches.group(3))
+            elif field == "Errors":
+                section["Errors"] = int(matches.group(1))
+                section["Warnings"] = int(matches.group(2))
+            elif field == "Chars":
+                section["Chars_Total"] = int(matches.group(3))
+                section["Chars_Wrong"] = int(matches.group(2))
+            else:
+                section["Successful"] = False
+                section["Error_Message"] = matches.group(1)
+
+            if max_sections is not None and len(sections) == max_sections \
+                    and len(seen) == len(OCR_LOG_FIELDS):
+                # All statistics of the last wanted section are there, only
+                # look for errors from now on
+                full = True
+
+    return sections
+
+
+def parse_ocr_log(directory, filename):
+    sections = parse_ocr_log_sections(os.path.join(directory, filename), 1)
+
+    if len(sections) > 0:
+        result = sections[0]
+    else:
+        result = get_ocr_section()
+
+    logging.debug("OCR parameters: %s", str(result))
+
+    return result
+
+
+def validate_pdf(pathname):
+    # Cheap structural checks, returns the page count and what is damaged
+    # (None if nothing)
+    try:
+        size = os.path.getsize(pathname)
+        with open(pathname, "rb") as handle:
+            head = handle.read(1024)
+            handle.seek(max(size - 2048, 0))
+            tail = handle.read()
+    except OSError as error:
+        return None, str(error)
+
+    if size == 0:
+        return None, "empty file"
+    if b"%PDF-" not in head:
+        return None, "no PDF header"
+    if b"%%EOF" not in tail:
+        return None, "truncated, no end of file marker"
+    if b"startxref" not in tail:
+        return None, "no cross-reference table"
+
+    pages = get_page_count(pathname)
+    if pages is None:
+        return None, "unreadable"
+    if pages == 0:
+        return pages, "no pages"
+
+    return pages, None
+
+
+def repair_pdf(pathname, ocr_queue):
+    # Writes a cleaned copy of pathname into ocr_queue under the same name.
+    # Returns None on success, otherwise why the repair failed.
+    filename = os.path.basename(pathname)
+    output = temporary_name(ocr_queue)
+
+    logging.info("Trying to repair PDF %s with mutool", filename)
+    start = time.time()
+    try:
+        result = subprocess.run(["mutool", "clean", pathname, output],
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                timeout=REPAIR_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as error:
+        discard_temporaries([output])
+        return str(error)
+    finally:
+        record_stage("repair", start, filename)
+
+    if result.returncode != 0:
+        discard_temporaries([output])
+        messages = result.stderr.decode("utf-8", "replace").splitlines()
+        return "mutool exited with {}: {}".format(
+            result.returncode, messages[-1] if len(messages) > 0 else "")
+
+    pages, damage = validate_pdf(output)
+    if damage is not None:
+        discard_temporaries([output])
+        return "still damaged after repair, " + damage
+
+    os.chmod(output, 0o777)
+    os.rename(output, os.path.join(ocr_queue, filename))
+
+    return None
+
+
+def get_repaired_document(filename):
+    # Documents repaired after failing OCR are queued again with a suffix
+    return filename.replace("_r.pdf", ".pdf")
+
+
+def record_repair(filename, result):
+    with transaction() as cursor:
+        cursor.execute(
+            '''UPDATE documents SET
+            repair_result=?, time_repaired=datetime("now") WHERE name=?''',
+            (result, get_repaired_document(filename)))
+
+
+def get_text_layer_pages(count):
+    if count <= TEXT_LAYER_PAGES:
+        return range(count)
+
+    return sorted(set([0, count // 2, count - 1]))
+
+
+def file_needs_ocr(filename):
+    # Pages are extracted one at a time, stopping as soon as there is
+    # enough text
+    length = 0
+
+    try:
+        with open(filename, "rb") as handle:
+            pages = pdftotext.PDF(handle)
+            for page in get_text_layer_pages(len(pages)):
+                length += len(pages[page].strip())
+                if length > TEXT_LAYER_THRESHOLD:
+                    break
+    except pdftotext.Error:
+        return True, None
+
+    ret = length <= TEXT_LAYER_THRESHOLD
+
+    logging.debug("file_needs_ocr: File %s has length %i, needs_ocr=%s",
+                  filename, length, ret)
+
+    return ret, length
+
+
+def get_text_layer(document_hash):
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        cursor.execute('SELECT needs_ocr FROM text_layers WHERE hash=?',
+                       (document_hash, ))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    return bool(row[0])
+
+
+def save_text_layer(document_hash, needs_ocr, length):
+    with transaction() as cursor:
+        cursor.execute(
+            'INSERT OR REPLACE INTO text_layers VALUES (?, ?, ?)',
+            (document_hash, int(needs_ocr), length))
+
+
+def document_needs_ocr(pathname, document_hash):
+    # The decision only depends on the content, look it up by hash first
+    needs_ocr = get_text_layer(document_hash)
+    if needs_ocr is not None:
+        logging.debug("Text layer of %s is known, needs_ocr=%s", pathname,
+                      needs_ocr)
+        return needs_ocr
+
+    with timed("needs_ocr"):
+        needs_ocr, length = file_needs_ocr(pathname)
+    save_text_layer(document_hash, needs_ocr, length)
+
+    return needs_ocr
+
+
+def get_text_signature(pathname):
+    # MinHash over word shingles of the sampled pages, None without text
+    try:
+        with open(pathname, "rb") as handle:
+            pages = pdftotext.PDF(handle)
+            words = []
+            for page in get_text_layer_pages(len(pages)):
+                words.extend(pages[page].lower().split())
+    except pdftotext.Error:
+        return None
+
+    shingles = set()
+    for index in range(len(words) - SHINGLE_WORDS + 1):
+        shingle = " ".join(words[index:index + SHINGLE_WORDS])
+        shingles.add(zlib.crc32(shingle.encode("utf-8")))
+
+    if len(shingles) < MINHASH_BANDS:
+        return None
+
+    signature = []
+    for a, b in MINHASH_SEEDS:
+        signature.append(
+            min([(a * shingle + b) % MINHASH_PRIME for shingle in shingles]))
+
+    return signature
+
+
+def read_pgm(data):
+    # Binary greymap as written by mutool: P5 <width> <height> <maxval>
+    header = PGM_HEADER.match(data)
+    if header is None:
+        return None
+
+    width = int(header.group(1))
+    height = int(header.group(2))
+    pixels = data[header.end():header.end() + width * height]
+    if len(pixels) < width * height or width < 9 or height < 8:
+        return None
+
+    return width, height, pixels
+
+
+def get_image_signature(pathname):
+    # Difference hash of the first page, rendered at a low resolution
+    directory = tempfile.mkdtemp()
+    output = os.path.join(directory, "page.pgm")
+
+    try:
+        subprocess.run([
+            "mutool", "draw", "-r", "20", "-c", "gray", "-o", output,
+            pathname, "1"
+        ],
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       timeout=60)
+        with open(output, "rb") as file:
+            image = read_pgm(file.read())
+    except (OSError, subprocess.TimeoutExpired) as error:
+        logging.debug("Unable to render %s (%s)", pathname, error)
+        return None
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if image is None:
+        return None
+
+    # Shrink to 9x8 cells by averaging
+    width, height, pixels = image
+    cells = []
+    for row in range(8):
+        top = row * height // 8
+        bottom = (row + 1) * height // 8
+        for column in range(9):
+            left = column * width // 9
+            right = (column + 1) * width // 9
+            total = 0
+            for y in range(top, bottom):
+                total += sum(pixels[y * width + left:y * width + right])
+            cells.append(total / ((bottom - top) * (right - left)))
+
+    # Blank pages all look the same
+    if max(cells) - min(cells) < 8:
+        return None
+
+    signature = 0
+    for row in range(8):
+        for column in range(8):
+            signature <<= 1
+            if cells[row * 9 + column] > cells[row * 9 + column + 1]:
+                signature |= 1
+
+    return signature
+
+
+def get_similarity(pathname):
+    return {
+        "text": get_text_signature(pathname),
+        "image": get_image_signature(pathname)
+    }
+
+
+def get_similarity_buckets(similarity):
+    buckets = []
+
+    text = similarity["text"]
+    if text is not None:
+        rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        for band in range(MINHASH_BANDS):
+            bucket = struct.pack("<{:d}Q".format(rows),
+                                 *text[band * rows:(band + 1) * rows])
+            buckets.append(("text", band, bucket.hex()))
+
+    image = similarity["image"]
+    if image is not None:
+        # Signatures within DHASH_DISTANCE bits differ in at most that many
+        # of their 8 bytes, so they share at least one
+        for band in range(8):
+            bucket = (image >> (band * 8)) & 0xff
+            buckets.append(("image", band, "{:02x}".format(bucket)))
+
+    return buckets
+
+
+def is_similar(similarity, text, image):
+    # Documents with text are judged on it alone, a shared letterhead or
+    # layout is enough to make the coarse page hashes match
+    if similarity["text"] is not None and text is not None:
+        text = struct.unpack("<{:d}Q".format(MINHASH_PERMUTATIONS), text)
+        equal = 0
+        for left, right in zip(similarity["text"], text):
+            if left == right:
+                equal += 1
+        return equal >= SIMILARITY_THRESHOLD * MINHASH_PERMUTATIONS
+
+    if similarity["image"] is not None and image is not None:
+        distance = bin(similarity["image"] ^ int(image, 16)).count("1")
+        if distance <= DHASH_DISTANCE:
+            return True
+
+    return False
+
+
+def find_near_duplicate(similarity):
+    # Candidates share an LSH bucket, they are verified on the signature
+    buckets = get_similarity_buckets(similarity)
+    if len(buckets) == 0:
+        return None
+
+    # All candidates and their signatures come back in a single query
+    condition = " OR ".join(["(kind=? AND band=? AND bucket=?)"] *
+                            len(buckets))
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        cursor.execute(
+            '''SELECT name, text, image FROM similarities
+            WHERE name IN (SELECT name FROM similarity_bands WHERE {})
+            ORDER BY name'''.format(condition),
+            [value for bucket in buckets for value in bucket])
+        rows = cursor.fetchall()
+
+    for name, text, image in rows:
+        if is_similar(similarity, text, image):
+            return name
+
+    return None
+
+
+def save_similarity(name, similarity):
+    text = similarity["text"]
+    if text is not None:
+        text = struct.pack("<{:d}Q".format(MINHASH_PERMUTATIONS), *text)
+
+    image = similarity["image"]
+    if image is not None:
+        image = "{:016x}".format(image)
+
+    with transaction() as cursor:
+        cursor.execute('INSERT OR REPLACE INTO similarities VALUES (?, ?, ?)',
+                       (name, text, image))
+        cursor.executemany(
+            'INSERT INTO similarity_bands VALUES (?, ?, ?, ?)',
+            [(kind, band, bucket, name)
+             for kind, band, bucket in get_similarity_buckets(similarity)])
+
+
+def cleanup_ocr_in(ocr_in, ocr_fail, ocr_repair, error=None, document=None):
+    # OCR seems to have failed - update status and move away file
+    failed_ocr = glob.glob(os.path.join(ocr_in, "*.[pP][dD][fF]"))
+    if len(failed_ocr) == 0:
+        logging.error("Failed OCR: Input vanished, deleting log")
+        if document is not None:
+            with transaction():
+                update_status(document, "ocr_failed")
+                save_log(document, error)
+        return True
+
+    if len(failed_ocr) > 1:
+        logging.error("Failed OCR: Multiple OCR files in %s (%s)", ocr_in,
+                      str(failed_ocr))
+
+    for pathname in failed_ocr:
+        fail_ocr_file(pathname, ocr_fail, ocr_repair, error)
+
+    return True
+
+
+def fail_ocr_file(pathname, ocr_fail, ocr_repair, error=None):
+    # Have the PDF repaired and put into the queue again
+    filename = os.path.basename(pathname)
+    if "_r.pdf" in filename:
+        logging.error("%s has been repaired and failed again", filename)
+    else:
+        link_file(pathname,
+                  os.path.join(ocr_repair, filename.replace(".pdf", "_r.pdf")))
+
+    # Put pdf into failed folder
+    logging.error("OCR for %s failed with %s, moving to %s", filename, error,
+                  ocr_fail)
+    shutil.move(pathname, os.path.join(ocr_fail, filename))
+    os.chmod(os.path.join(ocr_fail, filename), 0o777)
+
+    with transaction():
+        update_status(filename, "ocr_failed")
+        save_log(filename, error)
+
+
+def get_ocr_slots(dirs):
+    # Slot 0 uses the classic 03_ocr_in / 04_ocr_out hot folder, further
+    # slots get numbered folders of their own
+    slots = []
+
+    for index in range(OCR_SLOTS):
+        if index == 0:
+            in_key = "ocr_in"
+            out_key = "ocr_out"
+        else:
+            in_key = "ocr_in_{:d}".format(index)
+            out_key = "ocr_out_{:d}".format(index)
+            dirs[in_key] = "03_ocr_in_{:d}".format(index)
+            dirs[out_key] = "04_ocr_out_{:d}".format(index)
+
+        timeout = os.environ.get("OCR_TIMEOUT_{:d}".format(index))
+        if timeout is None:
+            timeout = OCR_TIMEOUT
+
+        slots.append({
+            "index": index,
+            "in_key": in_key,
+            "out_key": out_key,
+            "in": dirs[in_key],
+            "out": dirs[out_key],
+            "timeout": float(timeout),
+            "document": None,
+            "started": None,
+            "deadline": None
+        })
+
+    return slots
+
+
+def restore_ocr_slots(slots):
+    # Documents left in a hot folder are still being worked on
+    for slot in slots:
+        files = glob.glob(os.path.join(slot["in"], "*.[pP][dD][fF]"))
+        if len(files) == 0:
+            continue
+
+        slot["document"] = os.path.basename(files[0])
+        slot["started"] = time.time()
+        slot["deadline"] = start_ocr_deadline(slot["in"], slot["document"],
+                                              slot["timeout"])
+        logging.info("OCR slot %i is busy with %s", slot["index"],
+                     slot["document"])
+
+
+def free_ocr_slot(slot):
+    slot["document"] = None
+    slot["started"] = None
+    slot["deadline"] = None
+
+
+def is_ocr_slot_free(slot):
+    if slot["document"] is not None:
+        return False
+
+    if len(glob.glob(os.path.join(slot["in"], "*"))) > 0:
+        return False
+
+    return len(glob.glob(os.path.join(slot["out"], "*"))) == 0
+
+
+def get_ocr_queue(ocr_queue):
+    files = []
+
+    for file in os.listdir(ocr_queue):
+        if not os.path.isfile(os.path.join(ocr_queue, file)):
+            continue
+
+        filename, file_extension = os.path.splitext(file)
+        if file_extension.lower() != ".pdf":
+            continue
+
+        # Workers may still be writing into the queue
+        if not is_file_stable(os.path.join(ocr_queue, file)):
+            continue
+
+        files.append(file)
+
+    return files
+
+
+def get_ocr_model():
+    # OCR time is modelled as fixed + per_page * pages, fitted to the
+    # history of finished documents and refreshed every few minutes
+    if (time.time() - OCR_MODEL["updated"]) < 600:
+        return OCR_MODEL
+
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        cursor.execute('''SELECT ocr_pages, ocr_time FROM documents
+            WHERE ocr_pages > 0 AND ocr_time IS NOT NULL
+            ORDER BY rowid DESC LIMIT 500''')
+        samples = cursor.fetchall()
+
+    OCR_MODEL["updated"] = time.time()
+    if len(samples) < 5:
+        return OCR_MODEL
+
+    count = len(samples)
+    rates = sorted([seconds / pages for pages, seconds in samples])
+    OCR_MODEL["rate"] = rates[min(int(OCR_TIMEOUT_PERCENTILE * count),
+                                  count - 1)]
+
+    mean_pages = sum([pages for pages, seconds in samples]) / count
+    mean_time = sum([seconds for pages, seconds in samples]) / count
+    variance = sum([(pages - mean_pages)**2 for pages, seconds in samples])
+    if variance > 0:
+        covariance = sum([(pages - mean_pages) * (seconds - mean_time)
+                          for pages, seconds in samples])
+        per_page = max(covariance / variance, 0)
+    else:
+        per_page = mean_time / mean_pages
+
+    OCR_MODEL["per_page"] = per_page
+    OCR_MODEL["fixed"] = max(mean_time - per_page * mean_pages, 0)
+    logging.debug("OCR model: %s", str(OCR_MODEL))
+
+    return OCR_MODEL
+
+
+def estimate_ocr_time(pages):
+    model = get_ocr_model()
+    if pages is None:
+        pages = 1
+
+    return model["fixed"] + model["per_page"] * pages
+
+
+def get_ocr_deadline(pages, timeout):
+    # Seconds a document may spend in OCR, timeout if there is no history
+    model = get_ocr_model()
+    if pages is None or model["rate"] is None:
+        return timeout
+
+    return max(OCR_TIMEOUT_MARGIN * model["rate"] * pages,
+               OCR_TIMEOUT_MINIMUM)
+
+
+def start_ocr_deadline(directory, filename, timeout):
+    # Predicts the deadline of a document entering OCR and keeps it with
+    # the estimate for tuning
+    pages = get_document_pages(directory, filename)
+    predicted = estimate_ocr_time(pages)
+    deadline = get_ocr_deadline(pages, timeout)
+    logging.debug("OCR of %s (%s pages) predicted to take %i s, deadline %i s",
+                  filename, pages, predicted, deadline)
+
+    with transaction() as cursor:
+        cursor.execute(
+            '''UPDATE documents SET ocr_predicted=?, ocr_deadline=?
+            WHERE name=?''', (predicted, deadline, filename))
+
+    return deadline
+
+
+def stop_ocr_deadline(filename, started, deadline):
+    # Records how long OCR actually took, mispredictions are the documents
+    # with ocr_duration far from ocr_predicted or beyond ocr_deadline
+    duration = time.time() - started
+    with transaction() as cursor:
+        cursor.execute('UPDATE documents SET ocr_duration=? WHERE name=?',
+                       (duration, filename))
+
+    if deadline is not None and duration >= deadline:
+        increment("orchestrator_ocr_timeouts_total", {})
+        save_log(
+            filename, "ocr exceeded its deadline of {:.0f} s after {:.0f} s".
+            format(deadline, duration))
+
+
+def get_page_count(pathname):
+    try:
+        with open(pathname, "rb") as handle:
+            return len(pdftotext.PDF(handle))
+    except (OSError, pdftotext.Error):
+        return None
+
+
+def get_document_pages(directory, filename):
+    with DB_LOCK:
+        cursor = get_database().cursor()
+        cursor.execute('SELECT pages FROM documents WHERE name=?',
+                       (filename, ))
+        row = cursor.fetchone()
+
+    if row is not None and row[0] is not None:
+        return row[0]
+
+    # e.g. repaired documents, count once while they are queued
+    if filename not in QUEUE_PAGES:
+        QUEUE_PAGES[filename] = get_page_count(
+            os.path.join(directory, filename))
+
+    return QUEUE_PAGES[filename]
+
+
+def get_document_source(filename):
+    matches = ORCHESTRATED_REGEX.match(filename)
+    if matches is None:
+        return None
+
+    return matches.group(9).lower()
+
+
+def order_ocr_queue(ocr_queue, files):
+    # QUEUE_POLICY=fifo serves the oldest document first, sjf the cheapest
+    # one. hrrn (default) uses the response ratio (age + cost) / cost, so
+    # short documents go first without starving long ones. The weight of
+    # the source multiplies the score.
+    now = time.time()
+    entries = []
+
+    for file in files:
+        pages = get_document_pages(ocr_queue, file)
+        source = get_document_source(file)
+        cost = max(estimate_ocr_time(pages), 1)
+        try:
+            age = max(now - os.stat(os.path.join(ocr_queue, file)).st_ctime,
+                      0)
+        except FileNotFoundError:
+            continue
+
+        if QUEUE_POLICY == "fifo":
+            score = age
+        elif QUEUE_POLICY == "sjf":
+            score = 1 / cost
+        else:
+            score = (age + cost) / cost
+
+        entries.append({
+            "name": file,
+            "source": source,
+            "pages": pages,
+            "estimate": cost,
+            "age": age,
+            "score": score * QUEUE_WEIGHTS.get(source, 1.0)
+        })
+
+    entries.sort(key=lambda entry: entry["score"], reverse=True)
+
+    return entries
+
+
+def write_queue_state(entries, busy, pathname):
+    # Predicts start times by handing out the ordered queue to whichever
+    # worker becomes available first, busy holds the remaining seconds of
+    # the documents being worked on
+    now = time.time()
+    available = sorted([max(remaining, 0) for remaining in busy])
+    if len(available) == 0:
+        available = [0]
+
+    for entry in entries:
+        start = available.pop(0)
+        entry["predicted_start"] = datetime.fromtimestamp(
+            now + start).isoformat(timespec="seconds")
+        available.append(start + entry["estimate"])
+        available.sort()
+
+    state = {
+        "updated": datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+        "policy": QUEUE_POLICY,
+        "model": {
+            "fixed": OCR_MODEL["fixed"],
+            "per_page": OCR_MODEL["per_page"]
+        },
+        "queue": entries
+    }
+
+    temporary = temporary_name(os.path.dirname(pathname))
+    with open(temporary, "w") as file:
+        json.dump(state, file, indent=2)
+    os.rename(temporary, pathname)
+
+
+def dispatch_ocr_queue(slots, ocr_queue, state):
+    for slot in slots:
+        if slot["document"] is not None:
+            logging.info("OCR slot %i is busy with %s since %i s",
+                         slot["index"], slot["document"],
+                         time.time() - slot["started"])
+
+    entries = order_ocr_queue(ocr_queue, get_ocr_queue(ocr_queue))
+
+    for slot in slots:
+        if len(entries) == 0:
+            break
+
+        if not is_ocr_slot_free(slot):
+            continue
+
+        file = entries[0]["name"]
+        if serve_ocr_queue(ocr_queue, file, slot["in"]):
+            entries.pop(0)
+            slot["document"] = file
+            slot["started"] = time.time()
+            slot["deadline"] = start_ocr_deadline(slot["in"], file,
+                                                  slot["timeout"])
+            QUEUE_PAGES.pop(file, None)
+
+    busy = []
+    for slot in slots:
+        if slot["document"] is not None:
+            busy.append(
+                estimate_ocr_time(get_document_pages(
+                    slot["in"], slot["document"])) -
+                (time.time() - slot["started"]))
+        elif not is_ocr_slot_free(slot):
+            busy.append(0)
+
+    write_queue_state(entries, busy, state)
+
+
+def handle_ocr_output(slot, dirs):
+    # Returns whether the slot has been freed
+    freed = False
+
+    files = glob.glob(os.path.join(slot["out"], "*.[pP][dD][fF]"))
+    for fullfile in files:
+        # Make sure that files have not been recently changed before touching them
+        if not is_file_stable(fullfile):
+            continue
+
+        file = os.path.basename(fullfile)
+        if not process_ocred_file(slot["out"], file, dirs["consumption"],
+                                  dirs["archive_ocred"], dirs["store"]):
+            continue
+
+        if slot["started"] is not None:
+            record_stage("ocr", slot["started"], file)
+            stop_ocr_deadline(file, slot["started"], slot["deadline"])
+
+        free_ocr_slot(slot)
+        freed = True
+
+    # A log without an output PDF means that the OCR has failed
+    files = glob.glob(os.path.join(slot["out"], "Hot Folder Log*.txt"))
+    if len(files) > 0:
+        logging.info("Found %i logfiles in %s", len(files), slot["out"])
+    for fullfile in files:
+        # Make sure that files have not been recently changed before touching them
+        if not is_file_stable(fullfile):
+            continue
+
+        if len(glob.glob(os.path.join(slot["out"], "*.[pP][dD][fF]"))) > 0:
+            logging.warning("OCR output PDF suddenly appeared, skipping")
+            break
+
+        filename = os.path.basename(fullfile)
+        logging.error("Found file %s in %s. Parsing", filename, slot["out"])
+
+        stats = parse_ocr_log(slot["out"], filename)
+
+        if slot["document"] is not None:
+            # The log belongs to the document this slot is working on
+            preserve_hfl(slot["document"], fullfile)
+        else:
+            # No document known for this slot
+            preserve_hfl("stale_" + str(time.time()), fullfile)
+
+        if stats["Successful"]:
+            logging.info("OCR was successful, deleted stale log")
+            continue
+
+        cleanup_ocr_in(slot["in"], dirs["ocr_fail"], dirs["ocr_repair"],
+                       stats["Error_Message"], slot["document"])
+        free_ocr_slot(slot)
+        freed = True
+
+    return freed
+
+
+def check_ocr_timeout(slot, dirs):
+    # Returns whether the slot has been freed
+    if slot["document"] is None:
+        return False
+
+    duration = time.time() - slot["started"]
+    if duration < slot["deadline"]:
+        return False
+
+    logging.error("OCR of %s in slot %i timed out after %i, moving to fails",
+                  slot["document"], slot["index"], duration)
+    stop_ocr_deadline(slot["document"], slot["started"], slot["deadline"])
+
+    # Remove files from the slot
+    cleanup_ocr_in(slot["in"], dirs["ocr_fail"], dirs["ocr_repair"],
+                   "ocr timeout", slot["document"])
+    free_ocr_slot(slot)
+
+    return True
+
+
+def run_local_ocr(source, directory, timeout=OCR_TIMEOUT):
+    # Runs the local OCR engine on source, writing a temporary output PDF
+    # into directory. Returns the output path (None on failure) together
+    # with statistics shaped like the ones parsed from Hot Folder Logs.
+    values = get_ocr_section()
+    output = temporary_name(directory)
+    sidecar = output + ".txt"
+
+    command = [OCR_COMMAND] + OCR_ARGUMENTS + [
+        "--sidecar", sidecar, source, output
+    ]
+    logging.debug("Running %s", " ".join(command))
+
+    start = time.time()
+    try:
+        result = subprocess.run(command,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as error:
+        discard_temporaries([output, sidecar])
+        values["Errors"] = 1
+        values["Error_Message"] = str(error)
+        values["Successful"] = False
+        return None, values
+    values["Time"] = int(round(time.time() - start))
+
+    messages = result.stderr.decode("utf-8", "replace").splitlines()
+    values["Warnings"] = len(
+        [line for line in messages if OCR_WARNING.search(line)])
+
+    if result.returncode != 0:
+        discard_temporaries([output, sidecar])
+        values["Errors"] = 1
+        values["Error_Message"] = "{} exited with {}: {}".format(
+            OCR_COMMAND, result.returncode,
+            messages[-1] if len(messages) > 0 else "")
+        values["Successful"] = False
+        return None, values
+    values["Errors"] = 0
+
+    # Pages are separated by form feeds in the sidecar
+    try:
+        with open(sidecar, encoding="utf-8", errors="replace") as file:
+            text = file.read()
+        values["Pages"] = len(text.rstrip("\f").split("\f"))
+        values["Chars_Total"] = len("".join(text.split()))
+    except OSError as error:
+        logging.warning("Unable to read OCR sidecar of %s (%s)", source,
+                        error)
+    discard_temporaries([sidecar])
+
+    return output, values
+
+
+def open_local_ocr():
+    ocr = {
+        "executor":
+        concurrent.futures.ThreadPoolExecutor(max_workers=OCR_WORKERS),
+        "active": {},
+        "started": {},
+        "deadlines": {}
+    }
+
+    logging.info("Running up to %i local OCR jobs", OCR_WORKERS)
+
+    return ocr
+
+
+def submit_local_ocr(ocr, filename, dirs):
+    ocr["started"][filename] = time.time()
+    ocr["deadlines"][filename] = start_ocr_deadline(dirs["ocr_in"], filename,
+                                                    OCR_TIMEOUT)
+    ocr["active"][filename] = ocr["executor"].submit(
+        run_local_ocr, os.path.join(dirs["ocr_in"], filename),
+        dirs["ocr_out"], ocr["deadlines"][filename])
+
+
+def restore_local_ocr(ocr, dirs):
+    # Documents left in the OCR input were interrupted, start them again
+    files = glob.glob(os.path.join(dirs["ocr_in"], "*.[pP][dD][fF]"))
+    for fullfile in files:
+        filename = os.path.basename(fullfile)
+        logging.info("Restarting OCR of %s", filename)
+        submit_local_ocr(ocr, filename, dirs)
+
+
+def dispatch_local_ocr(ocr, dirs):
+    entries = order_ocr_queue(dirs["ocr_queue"],
+                              get_ocr_queue(dirs["ocr_queue"]))
+
+    free = OCR_WORKERS - len(ocr["active"])
+    if free <= 0:
+        logging.info("Local OCR is busy with %i documents",
+                     len(ocr["active"]))
+
+    while free > 0 and len(entries) > 0:
+        filename = entries.pop(0)["name"]
+        if not serve_ocr_queue(dirs["ocr_queue"], filename, dirs["ocr_in"],
+                               exclusive=False):
+            continue
+        submit_local_ocr(ocr, filename, dirs)
+        QUEUE_PAGES.pop(filename, None)
+        free -= 1
+
+    busy = []
+    for filename in ocr["active"]:
+        busy.append(
+            estimate_ocr_time(get_document_pages(dirs["ocr_in"], filename)) -
+            (time.time() - ocr["started"][filename]))
+
+    write_queue_state(entries, busy,
+                      os.path.join(dirs["logs"], "ocr_queue.json"))
+
+
+def reap_local_ocr(ocr, dirs):
+    # Returns whether jobs have finished
+    finished = False
+
+    for filename in list(ocr["active"]):
+        if not ocr["active"][filename].done():
+            continue
+
+        future = ocr["active"].pop(filename)
+        started = ocr["started"].pop(filename)
+        stop_ocr_deadline(filename, started, ocr["deadlines"].pop(filename))
+        finished = True
+
+        error = future.exception()
+        if error is not None:
+            logging.error("OCR of %s failed", filename, exc_info=error)
+            fail_ocr_file(os.path.join(dirs["ocr_in"], filename),
+                          dirs["ocr_fail"], dirs["ocr_repair"], str(error))
+            continue
+
+        output, values = future.result()
+        logging.debug("OCR parameters: %s", str(values))
+
+        if output is None:
+            fail_ocr_file(os.path.join(dirs["ocr_in"], filename),
+                          dirs["ocr_fail"], dirs["ocr_repair"],
+                          values["Error_Message"])
+            with transaction():
+                add_ocr_parameters(filename, values)
+            continue
+
+        record_stage("ocr", started, filename)
+
+        logging.info("Handling OCRed file %s", filename)
+        store_ocred_file(output, filename, values, dirs["consumption"],
+                         dirs["archive_ocred"], dirs["store"])
+
+        os.unlink(output)
+        os.unlink(os.path.join(dirs["ocr_in"], filename))
+
+    return finished
+
+
+def close_local_ocr(ocr, dirs):
+    logging.info("Waiting for %i OCR jobs to finish", len(ocr["active"]))
+    ocr["executor"].shutdown(wait=True)
+    reap_local_ocr(ocr, dirs)
+
+
+def recover_documents(dirs, sources):
+    # Resumes documents interrupted by a crash from their last transition and
+    # lets files known to be complete skip the stability checks
+    locations = [dirs[key] for key in dirs if key.startswith("ocr_")]
+    resumed = 0
+
+    for name, state, hash_original in get_unfinished_documents():
+        blob = get_blob_path(dirs["store"], hash_original)
+        if not os.path.isfile(blob):
+            logging.error("Unable to resume %s, %s is missing", name, blob)
+            continue
+
+        if state == "ingested":
+            logging.info("Resuming %s from %s", name, state)
+            with transaction():
+                set_archive_paths(name,
+                                  raw=archive_file(blob, dirs["archive_raw"],
+                                                   name))
+                journal_document(name, "archived")
+            state = "archived"
+
+        queued = os.path.join(dirs["ocr_queue"], name)
+        present = [
+            directory for directory in locations
+            if os.path.isfile(os.path.join(directory, name))
+        ]
+        if len(present) == 0:
+            # Never queued or lost on the way to OCR
+            logging.info("Resuming %s (%s): saving to %s", name, state,
+                         dirs["ocr_queue"])
+            copy_file(blob, queued)
+            with transaction() as cursor:
+                cursor.execute(
+                    '''UPDATE documents SET
+                    status="new", last_update=datetime("now") WHERE name=?''',
+                    (name, ))
+                journal_document(name, "queued")
+            resumed += 1
+
+        # Links are renamed into place, the file is complete
+        if os.path.isfile(queued):
+            mark_file_closed(queued)
+
+    for source in sources:
+        directory = dirs[source["key"]]
+        for fullfile in glob.glob(os.path.join(directory, "*.[pP][dD][fF]")):
+            try:
+                signature = get_file_signature(fullfile)
+            except FileNotFoundError:
+                continue
+
+            if find_journaled_file(fullfile, signature) is not None:
+                mark_file_closed(fullfile)
+
+    if resumed > 0:
+        logging.info("Resumed %i interrupted documents", resumed)
+
+
+def open_repair():
+    return {
+        "executor":
+        concurrent.futures.ThreadPoolExecutor(max_workers=REPAIR_WORKERS),
+        "active": {}
+    }
+
 
+def dispatch_repairs(repair, dirs):
+    for fullfile in glob.glob(os.path.join(dirs["ocr_repair"],
+                                           "*.[pP][dD][fF]")):
+        if len(repair["active"]) >= REPAIR_WORKERS:
+            break
 
-def parse_filename_heuristic(filename, prefix, index, suffix):
-    regex_heuristic = r"([0-9]{4})[\-\._]{1}([0-9]{2})[\-\._]{1}([0-9]{2})" + \
-            r"[\-\._]{1}([0-9]{2})[\-\._]{1}([0-9]{2})[\-\._]{1}([0-9]{2})" + \
-            r".*\.pdf$"
-    matches = re.match(regex_heuristic, filename, re.IGNORECASE)
+        filename = os.path.basename(fullfile)
+        if filename in repair["active"] or not is_file_stable(fullfile):
+            continue
 
-    if matches is None:
-        return None
+        repair["active"][filename] = repair["executor"].submit(
+            repair_pdf, fullfile, dirs["ocr_queue"])
 
-    filename_no_ext, file_extension = os.path.splitext(filename)
 
-    name_list = [
-        str(prefix), "{:05d}".format(index),
-        matches.group(1),
-        matches.group(2),
-        matches.group(3),
-        matches.group(4),
-        matches.group(5),
-        matches.group(6),
-        str(suffix), filename_no_ext
-    ]
-    name = "-".join(name_list) + ".pdf"
+def reap_repairs(repair, dirs):
+    # Returns whether repairs have finished
+    finished = False
 
-    return name
+    for filename in list(repair["active"]):
+        if not repair["active"][filename].done():
+            continue
 
+        future = repair["active"].pop(filename)
+        finished = True
+
+        error = future.exception()
+        if error is None:
+            error = future.result()
+        else:
+            error = str(error)
+
+        pathname = os.path.join(dirs["ocr_repair"], filename)
+        document = get_repaired_document(filename)
+        if error is None:
+            logging.info("Repaired %s, saving to %s", filename,
+                         dirs["ocr_queue"])
+            os.unlink(pathname)
+            with transaction():
+                record_repair(filename, "repaired")
+                if document == filename:
+                    journal_document(document, "queued")
+            continue
 
-def parse_email_filename(filename, prefix, index, suffix):
-    # Format: 2021-1-18--VERTRAGSRELEVANTE_DOKUMENTE_dat20200928_id909128141.pdf
-    regex_email = r"([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})--(.*)$"
+        logging.error("Repairing %s failed with %s, moving to %s", filename,
+                      error, dirs["ocr_fail"])
+        target = os.path.join(dirs["ocr_fail"], document)
+        # After failed OCR the original is already there as a hardlink,
+        # renaming onto it would silently leave the file in place
+        if os.path.exists(target) and os.path.samefile(pathname, target):
+            os.unlink(pathname)
+        else:
+            shutil.move(pathname, target)
+            os.chmod(target, 0o777)
+        with transaction():
+            record_repair(filename, error)
+            if document == filename:
+                update_status(document, "repair_failed")
+            save_log(document, "repair failed: " + error)
+
+    return finished
+
+
+def close_repair(repair, dirs):
+    logging.info("Waiting for %i repairs to finish", len(repair["active"]))
+    repair["executor"].shutdown(wait=True)
+    reap_repairs(repair, dirs)
+
+
+def open_mirror(directory, spill):
+    mirror = {
+        "directory": directory,
+        "spill": spill,
+        "compression": MIRROR_COMPRESSION,
+        "queue": queue.Queue(MIRROR_QUEUE_SIZE),
+        "stop": threading.Event(),
+        "failed": set(),
+        "thread": None
+    }
 
-    filename_no_ext, file_extension = os.path.splitext(filename)
+    if mirror["compression"] == "zstd" and zstandard is None:
+        logging.warning("zstandard is not installed, mirroring uncompressed")
+        mirror["compression"] = "none"
 
-    matches = re.match(regex_email, filename_no_ext, re.IGNORECASE)
+    mirror["thread"] = threading.Thread(target=run_mirror,
+                                        args=(mirror, ),
+                                        name="mirror",
+                                        daemon=True)
+    mirror["thread"].start()
 
-    if matches is None:
-        return None
+    return mirror
 
-    now = datetime.now()
-    name_list = [
-        str(None), "{:05d}".format(index),
-        "{:04d}".format(int(matches.group(1))),
-        "{:02d}".format(int(matches.group(2))),
-        "{:02d}".format(int(matches.group(3))),
-        now.strftime("%H"),
-        now.strftime("%M"),
-        now.strftime("%S"),
-        str(suffix),
-        matches.group(4)
-    ]
 
-    name = "-".join(name_list) + ".pdf"
+def mirror_file(mirror, source, filename):
+    # Hands source over to the mirror writer, never waits for it
+    if mirror is None:
+        return
 
-    return name
+    if zlib.crc32(filename.encode()) % 1000 >= MIRROR_SAMPLE_RATE * 1000:
+        increment("orchestrator_mirror_total", {"result": "sampled_out"})
+        return
 
+    try:
+        mirror["queue"].put_nowait((source, filename))
+    except queue.Full:
+        overflow_mirror(mirror, source, filename)
 
-def parse_orchestrated_filename(filename, prefix, index, suffix):
-    # Format: box00001-00008-2018-01-01-00-09-55-scanner.pdf
-    # Format: None-00443-2020-11-08-08-37-37-mobile-scan_2020-11-08-06.23-49 39.pdf
-    regex_orchestrator = r"([a-z0-9]+)-([0-9]+)-([0-9]+)-([0-9]+)-" + \
-            r"([0-9]+)-([0-9]+)-([0-9]+)-([0-9]+)-([a-z0-9]+)[-]*(.*)$"
 
-    filename_no_ext, file_extension = os.path.splitext(filename)
+def overflow_mirror(mirror, source, filename):
+    if MIRROR_OVERFLOW != "spill":
+        logging.warning("Mirror is behind, dropping %s", filename)
+        increment("orchestrator_mirror_total", {"result": "dropped"})
+        return
 
-    matches = re.match(regex_orchestrator, filename_no_ext, re.IGNORECASE)
+    logging.info("Mirror is behind, spilling %s to %s", filename,
+                 mirror["spill"])
+    link_file(source, os.path.join(mirror["spill"], filename))
+    increment("orchestrator_mirror_total", {"result": "spilled"})
 
-    if matches is None:
-        return None
 
-    name_list = [
-        matches.group(1), "{:05d}".format(index),
-        matches.group(3),
-        matches.group(4),
-        matches.group(5),
-        matches.group(6),
-        matches.group(7),
-        matches.group(8),
-        matches.group(9)
-    ]
+def get_spilled_file(mirror):
+    # Spilled files that failed are retried after the next successful write
+    for filename in sorted(os.listdir(mirror["spill"])):
+        if filename[0] != "." and filename not in mirror["failed"]:
+            return os.path.join(mirror["spill"], filename), filename
 
-    if len(matches.group(10)) > 0:
-        name_list.append(matches.group(10))
+    return None, None
 
-    name = "-".join(name_list) + ".pdf"
 
-    return name
+def write_mirror(mirror, source, filename):
+    destination = os.path.join(mirror["directory"], filename)
+    if mirror["compression"] != "zstd":
+        copy_file(source, destination)
+        return
 
+    temporary = temporary_name(mirror["directory"])
+    try:
+        with open(source, "rb") as source_handle:
+            with open(temporary, "wb") as destination_handle:
+                zstandard.ZstdCompressor().copy_stream(
+                    source_handle, destination_handle)
+        os.chmod(temporary, 0o777)
+        os.rename(temporary, destination + ".zst")
+    except BaseException:
+        discard_temporaries([temporary])
+        raise
+
+
+def run_mirror(mirror):
+    # Writes queued files first and spilled ones whenever it is idle
+    while not mirror["stop"].is_set():
+        spilled = False
+        try:
+            source, filename = mirror["queue"].get_nowait()
+        except queue.Empty:
+            source, filename = get_spilled_file(mirror)
+            spilled = source is not None
+
+        if source is None:
+            try:
+                source, filename = mirror["queue"].get(timeout=1)
+            except queue.Empty:
+                continue
+
+        written = False
+        try:
+            with timed("mirror"):
+                write_mirror(mirror, source, filename)
+            written = True
+        except OSError as error:
+            logging.error("Unable to mirror %s (%s)", filename, error)
+        except Exception:
+            logging.exception("Unable to mirror %s", filename)
+
+        # Spilled files are only removed once they made it to the mirror
+        if written:
+            increment("orchestrator_mirror_total", {"result": "written"})
+            mirror["failed"].clear()
+            if spilled:
+                os.unlink(source)
+        else:
+            increment("orchestrator_mirror_total", {"result": "failed"})
+            if spilled:
+                mirror["failed"].add(filename)
+
+
+def close_mirror(mirror):
+    # Files still queued are spilled or dropped
+    mirror["stop"].set()
+    mirror["thread"].join()
+
+    while not mirror["queue"].empty():
+        overflow_mirror(mirror, *mirror["queue"].get_nowait())
+
+
+def open_ingestion(sources):
+    ingestion = {
+        "executor":
+        concurrent.futures.ThreadPoolExecutor(max_workers=INGEST_WORKERS),
+        "limits": {},
+        "active": {}
+    }
 
-def process_scanner_file(directory,
-                         filename,
-                         prefix,
-                         ocr_in,
-                         consumption,
-                         archive_raw,
-                         archive_ocred,
-                         fail,
-                         strict=True,
-                         suffix=None,
-                         force_ocr=True):
-    name = None
-    index = get_index(archive_raw)
+    for source in sources:
+        value = os.environ.get("INGEST_LIMIT_" + source["suffix"].upper())
+        if value is None:
+            ingestion["limits"][source["key"]] = INGEST_WORKERS
+        else:
+            ingestion["limits"][source["key"]] = int(value)
+        ingestion["active"][source["key"]] = {}
 
-    logging.info(
-        "Handling scanned file %s (strict=%s, suffix=%s, force_ocr=%s)",
-        filename, strict, suffix, force_ocr)
-    wait_for_file_to_stabilize(os.path.join(directory, filename))
+    return ingestion
 
-    name = parse_app_filename(filename, prefix, index, suffix)
 
-    if name is None:
-        name = parse_adf_filename(filename, prefix, index, suffix)
+def submit_ingestion(ingestion, key, fullfile, *args, **kwargs):
+    active = ingestion["active"][key]
 
-    if name is None:
-        name = parse_canon_filename(filename, prefix, index, suffix)
+    if fullfile in active:
+        return True
 
-    if name is None:
-        name = parse_orchestrated_filename(filename, prefix, index, suffix)
+    if len(active) >= ingestion["limits"][key]:
+        return False
 
-    if name is None:
-        name = parse_email_filename(filename, prefix, index, suffix)
+    active[fullfile] = ingestion["executor"].submit(process_scanner_file,
+                                                    *args, **kwargs)
+    return True
 
-    if name is None:
-        name = parse_filename_heuristic(filename, prefix, index, suffix)
 
-    if name is None and strict:
-        logging.error("Unable to parse %s, moving to %s!", filename, fail)
+def reap_ingestion(ingestion, fail):
+    # Returns the sources in which jobs have finished. Files whose job
+    # raised are moved to fail instead of being picked up again.
+    finished = set()
 
-        shutil.move(os.path.join(directory, filename),
-                    os.path.join(fail, filename))
-        os.chmod(os.path.join(fail, filename), 0o777)
-        return
+    for key in ingestion["active"]:
+        active = ingestion["active"][key]
+        for fullfile in list(active):
+            if not active[fullfile].done():
+                continue
 
-    if name is None:
-        # Just make up a name as we go
-        filename_no_ext, file_extension = os.path.splitext(filename)
-
-        now = datetime.now()
-        name_list = [
-            str(prefix), "{:05d}".format(index),
-            now.strftime("%Y"),
-            now.strftime("%m"),
-            now.strftime("%d"),
-            now.strftime("%H"),
-            now.strftime("%M"),
-            now.strftime("%S"),
-            str(suffix), filename_no_ext
-        ]
-        name = "-".join(name_list) + ".pdf"
+            error = active.pop(fullfile).exception()
+            if error is not None:
+                logging.error("Ingesting %s failed, moving to %s", fullfile,
+                              fail, exc_info=error)
+                fail_ingestion(fullfile, fail)
+            finished.add(key)
 
-    logging.info("Created input file filename %s", name)
+    return finished
 
-    # Update Database
-    hash_value = get_hash(os.path.join(directory, filename))
 
-    if is_document_known(hash_value):
-        logging.error("%s already present in database, deleting", filename)
-        os.unlink(os.path.join(directory, filename))
-        return
+def fail_ingestion(fullfile, fail):
+    filename = os.path.basename(fullfile)
+    STABILITY.pop(fullfile, None)
 
-    if not add_document(filename, name, hash_value, "new"):
-        logging.error("%s already present, deleting", filename)
-        os.unlink(os.path.join(directory, filename))
+    try:
+        shutil.move(fullfile, os.path.join(fail, filename))
+    except FileNotFoundError:
         return
+    os.chmod(os.path.join(fail, filename), 0o777)
+
+
+def close_ingestion(ingestion, fail):
+    pending = 0
+    for key in ingestion["active"]:
+        pending += len(ingestion["active"][key])
+
+    logging.info("Waiting for %i ingestion jobs to finish", pending)
+    ingestion["executor"].shutdown(wait=True)
+    reap_ingestion(ingestion, fail)
+
+
+def tokenize_imap(response):
+    # Flattens an imaplib response into tokens, literals become strings
+    tokens = []
+    for item in response:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            prefix = IMAP_LITERAL.sub(b"", prefix)
+            tokens.extend(IMAP_TOKEN.findall(prefix))
+            tokens.append(b'"' + literal.replace(b"\\", b"\\\\").replace(
+                b'"', b'\\"') + b'"')
+        elif item is not None:
+            tokens.extend(IMAP_TOKEN.findall(item))
+
+    return tokens
+
+
+def parse_imap(tokens):
+    # Nested lists of bytes, None for NIL
+    stack = [[]]
+    for token in tokens:
+        if token == b"(":
+            stack.append([])
+        elif token == b")":
+            if len(stack) > 1:
+                value = stack.pop()
+                stack[-1].append(value)
+        elif token.upper() == b"NIL":
+            stack[-1].append(None)
+        elif token.startswith(b'"'):
+            stack[-1].append(
+                re.sub(rb'\\(.)', rb'\1', token[1:-1]))
+        else:
+            stack[-1].append(token)
+
+    return stack[0]
+
+
+def get_imap_pairs(values):
+    pairs = {}
+    if isinstance(values, list):
+        for index in range(0, len(values) - 1, 2):
+            if isinstance(values[index], bytes):
+                pairs[values[index].lower()] = values[index + 1]
+
+    return pairs
+
+
+def decode_imap_text(value):
+    if value is None:
+        return ""
+
+    text = value.decode("utf-8", "replace")
+    try:
+        return str(email.header.make_header(email.header.decode_header(text)))
+    except (email.errors.HeaderParseError, LookupError):
+        return text
+
+
+def get_pdf_parts(structure, part=""):
+    # Walks a BODYSTRUCTURE, returns (part, filename, encoding) of all PDFs
+    if len(structure) == 0:
+        return []
+
+    if isinstance(structure[0], list):
+        parts = []
+        for index, child in enumerate(structure):
+            if not isinstance(child, list):
+                break
+            if len(part) > 0:
+                child_part = "{}.{}".format(part, index + 1)
+            else:
+                child_part = str(index + 1)
+            parts.extend(get_pdf_parts(child, child_part))
+        return parts
 
-    # Copy to permanent archive
-    logging.info("Saving to %s", os.path.join(archive_raw, name))
-    shutil.copy2(os.path.join(directory, filename),
-                 os.path.join(archive_raw, name))
-    os.chmod(os.path.join(archive_raw, name), 0o777)
+    if len(structure) < 7 or not isinstance(structure[0], bytes):
+        return []
 
-    if force_ocr or file_needs_ocr(os.path.join(directory, filename)):
-        # Copy to OCR hot folder
-        logging.info("Saving to %s", os.path.join(ocr_in, name))
-        shutil.copy2(os.path.join(directory, filename),
-                     os.path.join(ocr_in, name))
-        os.chmod(os.path.join(ocr_in, name), 0o777)
-    else:
-        # Skip OCR, text is already there
-        logging.info("%s does not need OCR, bypassing queue", filename)
-        logging.info("Saving to %s", os.path.join(consumption, name))
-        shutil.copy2(os.path.join(directory, filename),
-                     os.path.join(consumption, name))
-        os.chmod(os.path.join(consumption, name), 0o777)
+    main_type = (structure[0] or b"").lower()
+    sub_type = (structure[1] or b"").lower()
+    parameters = get_imap_pairs(structure[2])
+    encoding = (structure[5] or b"7bit").lower()
 
-        logging.info("Saving to %s", os.path.join(archive_ocred, name))
-        shutil.copy2(os.path.join(directory, filename),
-                     os.path.join(archive_ocred, name))
-        os.chmod(os.path.join(archive_ocred, name), 0o777)
+    # text/* has the number of lines before the extension data
+    extension = 7
+    if main_type == b"text":
+        extension = 8
+    elif main_type == b"message" and sub_type == b"rfc822":
+        return []
 
-        # Update database
-        hash_ocr = get_hash(os.path.join(directory, filename))
-        add_ocr_hash(name, hash_ocr)
+    filename = decode_imap_text(parameters.get(b"name"))
 
-    # Remove input file
-    os.unlink(os.path.join(directory, filename))
+    # The disposition follows the MD5 in the extension data
+    disposition = None
+    if len(structure) > extension + 1:
+        disposition = structure[extension + 1]
+    if isinstance(disposition, list) and len(disposition) > 1:
+        parameters = get_imap_pairs(disposition[1])
+        if b"filename" in parameters:
+            filename = decode_imap_text(parameters[b"filename"])
 
+    if (main_type, sub_type) != (b"application", b"pdf") and \
+            not filename.lower().endswith(".pdf"):
+        return []
 
-def preserve_hfl(filename, hfl):
-    logging.debug("preserve_hfl(%s, %s)", filename, hfl)
+    return [(part or "1", filename, encoding)]
 
-    real_hfl = os.path.basename(hfl)
-    filename, file_extension = os.path.splitext(filename)
 
-    preserve_name = filename + "_" + real_hfl
-    logging.debug("preserve_name = %s", preserve_name)
+def get_email_filename(date, subject, filename):
+    # Format: 2021-1-18--VERTRAGSRELEVANTE_DOKUMENTE_dat20200928_id909128141.pdf
+    stem, extension = os.path.splitext(os.path.basename(filename))
+    name = "-".join([part for part in [subject, stem] if len(part) > 0])
+    name = EMAIL_UNSAFE.sub("_", name).strip("_")[:120] or "attachment"
+
+    return "{}-{}-{}--{}.pdf".format(date.year, date.month, date.day, name)
+
+
+def download_imap_part(connection, uid, part, encoding, pathname):
+    # Fetches the part in chunks, decoding base64 and quoted-printable on
+    # the way. What cannot be decoded yet is carried over to the next chunk.
+    rest = b""
+    offset = 0
+    with open(pathname, "wb") as file:
+        while True:
+            status, response = connection.uid(
+                "FETCH", uid, "(BODY.PEEK[{}]<{}.{}>)".format(
+                    part, offset, EMAIL_CHUNK_SIZE))
+            if status != "OK":
+                raise imaplib.IMAP4.error("FETCH failed: {}".format(status))
+
+            chunk = b""
+            for item in response:
+                if isinstance(item, tuple):
+                    chunk = item[1]
+                    break
 
-    shutil.move(hfl, os.path.join("logs", preserve_name))
-    os.chmod(os.path.join("logs", preserve_name), 0o777)
+            offset += len(chunk)
+            if encoding == b"base64":
+                data = rest + b"".join(chunk.split())
+                usable = len(data) - len(data) % 4
+                rest = data[usable:]
+                file.write(base64.b64decode(data[:usable]))
+            elif encoding == b"quoted-printable":
+                # Escapes and soft line breaks never span a line break
+                data = rest + chunk
+                usable = data.rfind(b"\n") + 1
+                rest = data[usable:]
+                file.write(quopri.decodestring(data[:usable]))
+            else:
+                file.write(chunk)
 
-    logging.debug("preserve done")
+            if len(chunk) < EMAIL_CHUNK_SIZE:
+                break
 
+        if encoding == b"quoted-printable":
+            file.write(quopri.decodestring(rest))
 
-def process_ocred_file(directory, filename, consumption, archive_ocred):
-    logging.info("Handling OCRed file %s", filename)
+        file.flush()
+        os.fsync(file.fileno())
 
-    # Make sure file is really done
-    wait_for_file_to_stabilize(os.path.join(directory, filename))
 
-    logging.info("Waiting for OCR Log to appear...")
-    path = os.path.join(directory, "Hot Folder Log*.txt")
-    while len(glob.glob(path)) < 1:
-        logging.debug("OCR Logs: %s", str(glob.glob(path)))
-        time.sleep(10)
+def fetch_emails(connection, directory, processed):
+    # Saves the PDFs of all new messages, returns the number of files
+    status, response = connection.uid("SEARCH", None, "ALL")
+    if status != "OK":
+        raise imaplib.IMAP4.error("SEARCH failed: {}".format(status))
 
-    logging.info("Saving to %s", os.path.join(consumption, filename))
-    shutil.copy2(os.path.join(directory, filename),
-                 os.path.join(consumption, filename))
-    os.chmod(os.path.join(consumption, filename), 0o777)
+    saved = 0
+    delete = []
+    for uid in response[0].split():
+        if uid in processed:
+            continue
 
-    logging.info("Saving to %s", os.path.join(archive_ocred, filename))
-    shutil.copy2(os.path.join(directory, filename),
-                 os.path.join(archive_ocred, filename))
-    os.chmod(os.path.join(archive_ocred, filename), 0o777)
+        status, response = connection.uid(
+            "FETCH", uid,
+            "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (DATE SUBJECT)])")
+        if status != "OK":
+            continue
 
-    # Update database
-    hash_ocr = get_hash(os.path.join(directory, filename))
-    add_ocr_hash(filename, hash_ocr)
+        # Format: 1 (UID 5 BODYSTRUCTURE (...) BODY[HEADER.FIELDS ...] "...")
+        values = []
+        for value in parse_imap(tokenize_imap(response)):
+            if isinstance(value, list):
+                values = value
+                break
+
+        structure = []
+        header = b""
+        for index in range(0, len(values) - 1):
+            if values[index] == b"BODYSTRUCTURE":
+                structure = values[index + 1]
+            elif isinstance(values[index], bytes) and \
+                    values[index].upper().startswith(b"BODY["):
+                header = values[index + 1] or b""
+
+        # Raw 8-bit subjects are not unusual despite RFC 2047
+        message = email.message_from_string(header.decode("utf-8", "replace"))
+        try:
+            date = email.utils.parsedate_to_datetime(message["Date"])
+        except (TypeError, ValueError):
+            date = datetime.now()
+        subject = decode_imap_text((message["Subject"] or "").encode())
+
+        parts = get_pdf_parts(structure)
+        for part, filename, encoding in parts:
+            name = get_email_filename(date, subject, filename)
+            if os.path.exists(os.path.join(directory, name)):
+                stem, extension = os.path.splitext(name)
+                name = "{}_{}{}".format(stem, uid.decode(), extension)
+
+            logging.info("Saving attachment %s of message %s as %s",
+                         filename, uid.decode(), name)
+            temporary = temporary_name(directory)
+            try:
+                download_imap_part(connection, uid, part, encoding,
+                                   temporary)
+            except BaseException:
+                discard_temporaries([temporary])
+                raise
+            os.chmod(temporary, 0o777)
+            os.rename(temporary, os.path.join(directory, name))
+            saved += 1
+
+        processed.add(uid)
+        if len(parts) > 0:
+            delete.append(uid)
+
+    if len(delete) > 0:
+        connection.uid("STORE", b",".join(delete), "+FLAGS", "(\\Deleted)")
+        connection.expunge()
+
+    return saved
+
+
+def is_imap_readable(connection):
+    # Looks for data in the buffer of imaplib and on the socket without
+    # blocking, select() alone would miss what has already been buffered
+    sock = connection.socket()
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return len(connection.file.peek(1)) > 0
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
 
-    # Read and save OCR parameters
-    hot_folder_log = glob.glob(os.path.join(directory, "Hot Folder Log*.txt"))
-    if len(hot_folder_log) > 1:
-        logging.error(
-            "Found %i Hot Folder Log Files: %s. Deleting all, parsing none.",
-            len(hot_folder_log), str(hot_folder_log))
-        for file in hot_folder_log:
-            preserve_hfl(filename, file)
 
-    if len(hot_folder_log) == 1:
-        logging.debug("Parsing %s", hot_folder_log[0])
-        # Make sure file is really done
-        wait_for_file_to_stabilize(hot_folder_log[0])
+def wait_for_email(connection, timeout):
+    # IDLE until the server announces new messages, SHUTDOWN or timeout
+    tag = "I{}".format(uuid.uuid4().hex[:8]).encode()
+    connection.send(tag + b" IDLE\r\n")
 
-        values = parse_ocr_log(directory, os.path.basename(hot_folder_log[0]))
-        add_ocr_parameters(filename, values)
-        preserve_hfl(filename, hot_folder_log[0])
+    line = connection.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error("IDLE rejected: {}".format(line))
 
-    # Remove input file
-    os.unlink(os.path.join(directory, filename))
+    deadline = time.time() + timeout
+    arrived = False
+    while not SHUTDOWN.is_set() and not arrived and time.time() < deadline:
+        if not is_imap_readable(connection):
+            select.select([connection.socket()], [], [], 1)
+            continue
 
+        line = connection.readline()
+        if len(line) == 0:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if b"EXISTS" in line or b"RECENT" in line:
+            arrived = True
 
-def check_status(directory):
-    connection = get_database()
-    cursor = connection.cursor()
+    connection.send(b"DONE\r\n")
+    while True:
+        line = connection.readline()
+        if len(line) == 0:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if line.startswith(tag + b" "):
+            break
 
-    result = cursor.execute('SELECT name FROM documents WHERE status="ocred"')
-    for row in result:
-        filename = row[0]
+    return arrived
 
-        if not os.path.isfile(os.path.join(directory, filename)):
-            logging.info("%s appears to have been consumed", filename)
-            update_status(filename, "consumed")
 
-    connection.commit()
+def open_imap(config):
+    if config["ssl"]:
+        connection = imaplib.IMAP4_SSL(config["server"], config["port"])
+    else:
+        connection = imaplib.IMAP4(config["server"], config["port"])
 
+    connection.login(config["user"], config["password"])
+    status, response = connection.select(config["folder"])
+    if status != "OK":
+        raise imaplib.IMAP4.error("Unable to select {}".format(
+            config["folder"]))
 
-def serve_ocr_queue(directory, filename, ocr_in):
-    if len(os.listdir(ocr_in)) > 0:
-        return False
+    return connection
 
-    logging.info("Starting OCR of %s", filename)
-    shutil.move(os.path.join(directory, filename),
-                os.path.join(ocr_in, filename))
-    os.chmod(os.path.join(ocr_in, filename), 0o777)
 
-    update_status(filename, "ocring")
+def run_email_fetcher(config, directory):
+    # Keeps one connection open, reconnecting with a growing delay
+    backoff = 5
+    processed = set()
 
-    return True
+    while not SHUTDOWN.is_set():
+        connection = None
+        try:
+            connection = open_imap(config)
+            logging.info("Connected to %s, folder %s", config["server"],
+                         config["folder"])
+            idle = "IDLE" in connection.capabilities
+            processed.clear()
+            backoff = 5
+
+            while not SHUTDOWN.is_set():
+                saved = fetch_emails(connection, directory, processed)
+                if saved > 0:
+                    logging.info("Fetched %i attachments from %s", saved,
+                                 config["server"])
+
+                # Messages announced while fetching are only buffered by
+                # imaplib, collect them before waiting for new ones
+                if connection.untagged_responses.pop("EXISTS",
+                                                     None) is not None:
+                    continue
 
+                if idle:
+                    wait_for_email(connection, EMAIL_IDLE_TIMEOUT)
+                else:
+                    SHUTDOWN.wait(EMAIL_POLL_INTERVAL)
+                    connection.noop()
+        except (OSError, imaplib.IMAP4.error) as error:
+            logging.error("Fetching emails from %s failed (%s), retrying in "
+                          "%i s", config["server"], error, backoff)
+            SHUTDOWN.wait(backoff)
+            backoff = min(backoff * 2, 300)
+        except Exception:
+            logging.exception("Fetching emails from %s failed, retrying in "
+                              "%i s", config["server"], backoff)
+            SHUTDOWN.wait(backoff)
+            backoff = min(backoff * 2, 300)
+        finally:
+            if connection is not None:
+                try:
+                    connection.logout()
+                except (OSError, imaplib.IMAP4.error):
+                    pass
+
+
+def open_email_fetcher(directory):
+    config = {
+        "server": os.environ.get("EMAIL_SERVER"),
+        "user": os.environ.get("EMAIL_USER"),
+        "password": os.environ.get("EMAIL_PASS"),
+        "folder": os.environ.get("EMAIL_FOLDER", "INBOX"),
+        "ssl": os.environ.get("EMAIL_SSL", "1") != "0",
+    }
 
-def parse_ocr_log(directory, filename):
-    regex_pages = r"^(?:Verarbeitete Seiten|Pages processed):[ \t]*([0-9]+).$"
-    regex_time = r"^(?:Erkennungszeit|Recognition time):[ \t]*([0-9]+) (?:Stunden|hours) ([0-9]+) (?:Minuten|minutes) ([0-9]+) (?:Sekunden|seconds).$"
-    regex_error = r"^(?:Fehler/Warnungen|Errors/warnings ):[ \t]*([0-9]+) / ([0-9]+).$"
-    regex_quali = r"^(?:Nicht eindeutige Zeichen|Low-confidence characters):[ \t]*([0-9]+) % \(([0-9]+) / ([0-9]+)\).$"
-    regex_reason = r"^[0-9\., :\t]+(?:Fehler|Error): (.*)$"
+    if config["server"] is None or config["user"] is None or \
+            config["password"] is None:
+        logging.info("Fetching emails is not configured, please set "
+                     "EMAIL_SERVER, EMAIL_USER and EMAIL_PASS")
+        return None
 
-    path = os.path.join(directory, filename)
+    port = 993 if config["ssl"] else 143
+    config["port"] = int(os.environ.get("EMAIL_PORT", port))
 
-    file = open(path, encoding='utf-16le')
-    content = file.readlines()
-    file.close()
+    thread = threading.Thread(target=run_email_fetcher,
+                              args=(config, directory),
+                              name="email",
+                              daemon=True)
+    thread.start()
 
-    result = {
-        "Pages": None,
-        "Time": None,
-        "Errors": None,
-        "Warnings": None,
-        "Chars_Total": None,
-        "Chars_Wrong": None,
-        "Error_Message": None,
-        "Successful": True,
-    }
+    return thread
 
-    for line in content:
-        matches = re.match(regex_pages, line)
-        if matches is not None:
-            result["Pages"] = int(matches.group(1))
 
-        matches = re.match(regex_time, line)
-        if matches is not None:
-            result["Time"] = int(matches.group(1)) * 3600 + int(
-                matches.group(2)) * 60 + int(matches.group(3))
+def close_email_fetcher(thread):
+    if thread is not None:
+        thread.join(10)
 
-        matches = re.match(regex_error, line)
-        if matches is not None:
-            result["Errors"] = int(matches.group(1))
-            result["Warnings"] = int(matches.group(2))
 
-        matches = re.match(regex_quali, line)
-        if matches is not None:
-            result["Chars_Total"] = int(matches.group(3))
-            result["Chars_Wrong"] = int(matches.group(2))
+def request_shutdown(signum, frame):
+    SHUTDOWN.set()
 
-        matches = re.match(regex_reason, line)
-        if matches is not None:
-            result["Successful"] = False
-            result["Error_Message"] = matches.group(1)
 
-    logging.debug("OCR parameters: %s", str(result))
+def get_poll_intervals(defaults):
+    intervals = {}
+    for key in defaults:
+        value = os.environ.get("POLL_INTERVAL_" + key.upper())
+        if value is None:
+            intervals[key] = defaults[key]
+        else:
+            intervals[key] = float(value)
 
-    return result
+    return intervals
 
 
-def repair_pdf(pathname, ocr_queue):
-    dirname = os.path.dirname(pathname)
-    filename = os.path.basename(pathname)
+def inotify_init():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
 
-    if "_r.pdf" in filename:
-        logging.error("%s has been repaired and failed again", filename)
-        return
+    return libc, fd
 
-    new_filename = filename.replace(".pdf", "_r.pdf")
 
-    logging.info("Trying to repair PDF %s with mutool", filename)
-    cmd = "mutool clean '" + pathname + "' '" + os.path.join(
-        ocr_queue, new_filename) + "'"
-    os.system(cmd)
+def inotify_add_watch(libc, fd, directory, mask):
+    wd = libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+    if wd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), directory)
 
+    return wd
+
+
+def read_inotify_events(fd):
+    events = []
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            break
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+
+    return events
+
+
+def open_watcher(dirs, masks, intervals, mode):
+    watcher = {
+        "fd": None,
+        "libc": None,
+        "wds": {},
+        "intervals": get_poll_intervals(intervals),
+        "last_poll": {},
+    }
+
+    for key in watcher["intervals"]:
+        watcher["last_poll"][key] = 0
+
+    if mode != "inotify":
+        logging.info("Watching directories by polling only")
+        return watcher
 
-def file_needs_ocr(filename):
     try:
-        with open(filename, "rb") as handle:
-            lines = pdftotext.PDF(handle)
-    except pdftotext.Error:
-        return True
+        watcher["libc"], watcher["fd"] = inotify_init()
+    except (OSError, AttributeError) as error:
+        logging.warning("inotify unavailable (%s), falling back to polling",
+                        error)
+        return watcher
 
-    text = "".join(lines)
-    length = len(text.strip())
-    ret = True
+    for key in masks:
+        try:
+            wd = inotify_add_watch(watcher["libc"], watcher["fd"], dirs[key],
+                                   masks[key])
+        except OSError as error:
+            # e.g. network shares, these are still covered by polling
+            logging.warning("Unable to watch %s (%s), polling only",
+                            dirs[key], error)
+            continue
+        watcher["wds"][wd] = key
+        logging.debug("Watching %s for events", dirs[key])
 
-    if len(text.strip()) > 50:
-        ret = False
+    return watcher
 
-    logging.debug("file_needs_ocr: File %s has length %i, needs_ocr=%s",
-                  filename, length, ret)
 
-    return ret
+def close_watcher(watcher):
+    if watcher["fd"] is not None:
+        os.close(watcher["fd"])
+        watcher["fd"] = None
 
 
-def cleanup_ocr_in(ocr_in, ocr_fail, ocr_queue, error=None):
-    # OCR seems to have failed - update status and move away file
-    failed_ocr = glob.glob(os.path.join(ocr_in, "*.[pP][dD][fF]"))
-    if len(failed_ocr) == 0:
-        logging.error("Failed OCR: Input vanished, deleting log")
-        return True
+def wait_for_changes(watcher, timeout):
+    # Returns the set of directory keys that need to be looked at, either
+    # because an event arrived or because their poll interval elapsed
+    due = set()
+    events = []
 
-    if len(failed_ocr) == 1:
-        # Make sure file is really done
-        wait_for_file_to_stabilize(failed_ocr[0])
+    now = time.time()
+    for key in watcher["intervals"]:
+        if (now - watcher["last_poll"][key]) >= watcher["intervals"][key]:
+            due.add(key)
+            watcher["last_poll"][key] = now
 
-        # Try to repair the PDF and put it into the queue again
-        repair_pdf(failed_ocr[0], ocr_queue)
+    if watcher["fd"] is None:
+        if len(due) == 0:
+            time.sleep(timeout)
+        return due, events
 
-        # Put pdf into failed folder
-        filename = os.path.basename(failed_ocr[0])
-        logging.error("OCR for %s failed with %s, moving to %s", filename,
-                      error, ocr_fail)
-        shutil.move(failed_ocr[0], os.path.join(ocr_fail, filename))
-        os.chmod(os.path.join(ocr_fail, filename), 0o777)
+    if len(due) == 0:
+        select.select([watcher["fd"]], [], [], timeout)
 
-        update_status(filename, "ocr_failed")
-        save_log(filename, error)
-        return True
+    for wd, mask, name in read_inotify_events(watcher["fd"]):
+        if mask & IN_Q_OVERFLOW:
+            logging.warning("inotify queue overflowed, rescanning everything")
+            due.update(watcher["intervals"])
+            continue
 
-    if len(failed_ocr) > 1:
-        logging.error("Failed OCR: Multiple OCR files in queue, aborting (%s)",
-                      str(failed_ocr))
-        time.sleep(86400)
+        key = watcher["wds"].get(wd)
+        if key is None:
+            continue
 
-    return False
+        logging.debug("Event 0x%x for %s in %s", mask, name, key)
+        due.add(key)
+        events.append((key, name, mask))
+
+    return due, events
 
 
 def main():
@@ -688,6 +3740,7 @@ def main():
         "email_in": "01_email",
         "parse_fail": "01_fail",
         "ocr_queue": "02_ocr_queue",
+        "ocr_repair": "02_ocr_repair",
         "ocr_in": "03_ocr_in",
         "ocr_out": "04_ocr_out",
         "ocr_fail": "04_ocr_fail",
@@ -696,9 +3749,17 @@ def main():
         "archive_raw": "archive_raw",
         "config": "config",
         "logs": "logs",
-        "mirror": "mirror"
+        "mirror": "mirror",
+        "mirror_spill": "mirror_spill",
+        "store": "store"
     }
 
+    # The local OCR backend does not need any hot folders
+    if OCR_BACKEND == "local":
+        slots = []
+    else:
+        slots = get_ocr_slots(dirs)
+
     for index in dirs:
         try:
             os.mkdir(dirs[index])
@@ -720,224 +3781,187 @@ def main():
     # Setup database
     logging.debug("Initializing SQLite DB")
     connection = open_database(dirs["config"])
+    seed_document_index(dirs["archive_raw"])
+    load_pending_consumption()
+    load_filename_parsers(dirs["config"])
+
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-store":
+        migrate_store(dirs["store"],
+                      [dirs["archive_raw"], dirs["archive_ocred"]])
+        close_database(connection)
+        return
 
-    last_scanner_out = 0
-    last_ocr_out = 0
-    last_ocr_queue = 0
-    last_consumption = 0
-    last_info = 0
-    last_email = 0
-    last_ocr_in = time.time()
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-archive":
+        migrate_archive(dirs["archive_raw"], "archive_raw")
+        migrate_archive(dirs["archive_ocred"], "archive_ocr")
+        close_database(connection)
+        return
 
-    logging.debug("Starting busy loop")
-    while True:
-        # Read current prefix
-        prefix = read_prefix(dirs["config"], "PREFIX")
+    # Input directories and how their files are to be ingested
+    sources = [
+        {"key": "scanner_in", "suffix": "scanner", "strict": True},
+        {"key": "mobile_in", "suffix": "mobile", "strict": False},
+        {"key": "email_in", "suffix": "email", "strict": False},
+    ]
 
-        if (time.time() - last_info) >= 600:
-            logging.info("Prefix: %s", prefix)
-            last_info = time.time()
+    ingestion = open_ingestion(sources)
 
-        # Process all files coming in from the scanner
-        if (time.time() - last_scanner_out) >= 6:
-            # logging.debug("Processing %s", dirs["scanner_in"])
-            files = glob.glob(
-                os.path.join(dirs["scanner_in"], "*.[pP][dD][fF]"))
-            for fullfile in files:
-                filename = os.path.basename(fullfile)
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
 
-                # Make sure that files have not been recently changed before touching them
-                if not is_file_stable(fullfile):
-                    continue
+    ocr = None
+    if OCR_BACKEND == "local":
+        ocr = open_local_ocr()
+        restore_local_ocr(ocr, dirs)
 
-                # Mirror all ingress files for testing
-                shutil.copy2(fullfile, os.path.join(dirs["mirror"], filename))
-                os.chmod(os.path.join(dirs["mirror"], filename), 0o777)
+    restore_ocr_slots(slots)
+    recover_documents(dirs, sources)
+    repair = open_repair()
+    mirror = open_mirror(dirs["mirror"], dirs["mirror_spill"])
 
-                process_scanner_file(dirs["scanner_in"], filename, prefix,
-                                     dirs["ocr_queue"], dirs["consumption"],
-                                     dirs["archive_raw"],
-                                     dirs["archive_ocred"], dirs["parse_fail"],
-                                     True, "scanner", True)
+    # Further OCR slots are watched and polled like the first one
+    masks = dict(WATCH_MASKS)
+    intervals = dict(POLL_INTERVALS)
+    for slot in slots:
+        masks[slot["in_key"]] = WATCH_MASKS["ocr_in"]
+        masks[slot["out_key"]] = WATCH_MASKS["ocr_out"]
+        intervals[slot["out_key"]] = POLL_INTERVALS["ocr_out"]
 
-            files = glob.glob(os.path.join(dirs["mobile_in"],
-                                           "*.[pP][dD][fF]"))
-            for fullfile in files:
-                filename = os.path.basename(fullfile)
+    # Watch directories via inotify unless WATCH_MODE=poll
+    watcher = open_watcher(dirs, masks, intervals,
+                           os.environ.get("WATCH_MODE", "inotify"))
 
-                # Make sure that files have not been recently changed before touching them
-                if not is_file_stable(fullfile):
-                    continue
+    metrics = open_metrics(dirs)
+    open_trace(os.environ.get("TRACE_FILE"))
+    metrics_file = os.environ.get("METRICS_FILE")
 
-                # Mirror all ingress files for testing
-                shutil.copy2(fullfile, os.path.join(dirs["mirror"], filename))
-                os.chmod(os.path.join(dirs["mirror"], filename), 0o777)
+    email_fetcher = open_email_fetcher(dirs["email_in"])
 
-                process_scanner_file(dirs["mobile_in"], filename, None,
-                                     dirs["ocr_queue"], dirs["consumption"],
-                                     dirs["archive_raw"],
-                                     dirs["archive_ocred"], dirs["parse_fail"],
-                                     False, "mobile", True)
+    last_info = 0
+    last_metrics = 0
 
-            files = glob.glob(os.path.join(dirs["email_in"], "*.[pP][dD][fF]"))
-            for fullfile in files:
-                filename = os.path.basename(fullfile)
+    logging.debug("Starting busy loop")
+    while not SHUTDOWN.is_set():
+        due, events = wait_for_changes(watcher, 1)
 
-                # Make sure that files have not been recently changed before touching them
-                if not is_file_stable(fullfile):
-                    continue
+        # Files whose writer is done can be handled without further sampling
+        for key, name, mask in events:
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                mark_file_closed(os.path.join(dirs[key], name))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                STABILITY.pop(os.path.join(dirs[key], name), None)
 
-                # Mirror all ingress files for testing
-                shutil.copy2(fullfile, os.path.join(dirs["mirror"], filename))
-                os.chmod(os.path.join(dirs["mirror"], filename), 0o777)
+        recheck_stable_files(set([dirs[key] for key in due]))
 
-                process_scanner_file(dirs["email_in"], filename, None,
-                                     dirs["ocr_queue"], dirs["consumption"],
-                                     dirs["archive_raw"],
-                                     dirs["archive_ocred"], dirs["parse_fail"],
-                                     False, "email", True)
+        # Look again at directories in which pending files have settled
+        for directory in update_stability():
+            for key in dirs:
+                if dirs[key] == directory:
+                    due.add(key)
 
-            last_scanner_out = time.time()
+        # Read current prefix
+        prefix = read_prefix(dirs["config"], "PREFIX")
 
-        # Process all files coming out of OCR
-        if (time.time() - last_ocr_out) >= 5:
-            # logging.debug("Processing %s", dirs["ocr_out"])
+        if (time.time() - last_info) >= 600:
+            logging.info("Prefix: %s", prefix)
+            logging.info("Filename parser hits: %s", get_parser_hits())
+            last_info = time.time()
 
-            files = glob.glob(os.path.join(dirs["ocr_out"], "*.[pP][dD][fF]"))
-            for fullfile in files:
-                # Make sure that files have not been recently changed before touching them
-                wait_for_file_to_stabilize(fullfile)
+        # Look again at sources in which workers have become available
+        due.update(reap_ingestion(ingestion, dirs["parse_fail"]))
 
-                file = os.path.basename(fullfile)
-                filename, file_extension = os.path.splitext(file)
-                process_ocred_file(dirs["ocr_out"], file, dirs["consumption"],
-                                   dirs["archive_ocred"])
-                last_ocr_in = None
+        # Process all files coming in from the scanner, mobile and email
+        for source in sources:
+            if source["key"] not in due:
+                continue
+
+            if source["strict"]:
+                source_prefix = prefix
+            else:
+                source_prefix = None
 
             files = glob.glob(
-                os.path.join(dirs["ocr_out"], "Hot Folder Log*.txt"))
-            if len(files) > 0:
-                logging.info("Found %i logfiles in ocr_out", len(files))
+                os.path.join(dirs[source["key"]], "*.[pP][dD][fF]"))
             for fullfile in files:
+                filename = os.path.basename(fullfile)
+
                 # Make sure that files have not been recently changed before touching them
-                wait_for_file_to_stabilize(fullfile)
-
-                if len(
-                        glob.glob(
-                            os.path.join(dirs["ocr_out"],
-                                         "*.[pP][dD][fF]"))) > 0:
-                    logging.warning(
-                        "OCR output PDF suddenly appeared, skipping")
+                if not is_file_stable(fullfile):
+                    continue
+
+                if not submit_ingestion(ingestion,
+                                        source["key"],
+                                        fullfile,
+                                        dirs[source["key"]],
+                                        filename,
+                                        source_prefix,
+                                        dirs["ocr_queue"],
+                                        dirs["consumption"],
+                                        dirs["archive_raw"],
+                                        dirs["archive_ocred"],
+                                        dirs["store"],
+                                        dirs["parse_fail"],
+                                        source["strict"],
+                                        source["suffix"],
+                                        True,
+                                        mirror=mirror,
+                                        repair=dirs["ocr_repair"]):
+                    # All workers for this source are busy
                     break
 
-                filename = os.path.basename(fullfile)
-                logging.error("Found file %s in %s. Parsing", filename,
-                              dirs["ocr_out"])
-
-                stats = parse_ocr_log(dirs["ocr_out"], filename)
-
-                candidate_pdfs = glob.glob(
-                    os.path.join(dirs["ocr_in"], "*.[pP][dD][fF]"))
-                if len(candidate_pdfs) == 1:
-                    # There is one PDF in the ocr_in folder and we have found the log for it
-                    candidate_pdf = os.path.basename(candidate_pdfs[0])
-                    preserve_hfl(candidate_pdf,
-                                 os.path.join(dirs["ocr_out"], filename))
-                else:
-                    # No clear matching this log to the input file
-                    preserve_hfl("stale_" + str(time.time()),
-                                 os.path.join(dirs["ocr_out"], filename))
+        # Process all files coming out of OCR
+        if ocr is not None and reap_local_ocr(ocr, dirs):
+            due.add("ocr_queue")
 
-                last_ocr_in = None
+        for slot in slots:
+            if slot["out_key"] in due and handle_ocr_output(slot, dirs):
+                # OCR is free again, serve the queue right away
+                due.add("ocr_queue")
 
-                if stats["Successful"]:
-                    logging.info("OCR was successful, deleted stale log")
-                    continue
+        # Check for OCR timeouts
+        for slot in slots:
+            if check_ocr_timeout(slot, dirs):
+                due.add("ocr_queue")
+
+        # Repaired documents are queued for OCR right away
+        if reap_repairs(repair, dirs):
+            due.update(["ocr_repair", "ocr_queue"])
 
-                cleanup_ocr_in(dirs["ocr_in"], dirs["ocr_fail"],
-                               dirs["ocr_queue"], stats["Error_Message"])
-            last_ocr_out = time.time()
+        if "ocr_repair" in due:
+            dispatch_repairs(repair, dirs)
 
         # Serve the OCR queue
-        if (time.time() - last_ocr_queue) >= 30:
-            # logging.debug("Processing %s", dirs["ocr_queue"])
-            if last_ocr_in is not None:
-                duration = time.time() - last_ocr_in
-            else:
-                duration = -1
-            logging.info("OCR Queue is at %i since %i s",
-                         len(os.listdir(dirs["ocr_in"])), duration)
+        for slot in slots:
+            if slot["in_key"] in due:
+                due.add("ocr_queue")
 
-            if len(glob.glob(os.path.join(dirs["ocr_out"], "*"))) > 0 or len(
-                    glob.glob(os.path.join(dirs["ocr_in"], "*"))) > 0:
-                logging.warning("Need to process OCR queue first, skipping")
-            else:
-                files = os.listdir(dirs["ocr_queue"])
-                for file in files:
-                    if not os.path.isfile(os.path.join(dirs["ocr_queue"],
-                                                       file)):
-                        continue
-
-                    filename, file_extension = os.path.splitext(file)
-                    if file_extension.lower() != ".pdf":
-                        continue
-
-                    ret = serve_ocr_queue(dirs["ocr_queue"], file,
-                                          dirs["ocr_in"])
-
-                    if ret:
-                        last_ocr_in = time.time()
-            last_ocr_queue = time.time()
-
-        # Check for status of all files in the DB
-        if (time.time() - last_consumption) >= 600:
-            check_status(dirs["consumption"])
-            last_consumption = time.time()
-
-        time.sleep(1)
-
-        # Check for OCR timeout
-        if (last_ocr_in is not None) and len(os.listdir(
-                dirs["ocr_in"])) > 0 and (time.time() - last_ocr_in) >= 3600:
-            logging.error("OCR timed out after %i, moving to fails",
-                          (time.time() - last_ocr_in))
-
-            # Remove files from ocr_in
-            cleanup_ocr_in(dirs["ocr_in"], dirs["ocr_fail"], dirs["ocr_queue"],
-                           "ocr timeout")
-
-            # Make sure that queue is considered empty
-            last_ocr_in = None
-
-            # Make sure that the OCR queue is served right away to avoid delays
-            last_ocr_queue = 0
-
-        if last_email is not None and (time.time() - last_email) >= 600:
-            email_server = os.environ.get("EMAIL_SERVER")
-            email_user = os.environ.get("EMAIL_USER")
-            email_pass = os.environ.get("EMAIL_PASS")
-            email_folder = os.environ.get("EMAIL_FOLDER")
-
-            if email_folder is None:
-                email_folder = "INBOX"
-
-            if email_server is None or email_user is None or email_pass is None:
-                logging.info(
-                    "Fetching emails is not configured, please set " + \
-                            "EMAIL_SERVER, EMAIL_USER and EMAIL_PASS"
-                )
-                last_email = None
+        if "ocr_queue" in due:
+            if ocr is not None:
+                dispatch_local_ocr(ocr, dirs)
             else:
-                logging.debug("Retrieving email from %s", email_server)
-                subprocess.call([
-                    "detach.py", "-v", "-H", email_server, "-u", email_user,
-                    "-p", email_pass, "--folder", email_folder, "--delete",
-                    "-f", dirs["email_in"] +
-                    "/{year}-{month}-{day}-{subject}-{name}",
-                    "mime= \"application/pdf\""
-                ])
-                last_email = time.time()
-
+                dispatch_ocr_queue(
+                    slots, dirs["ocr_queue"],
+                    os.path.join(dirs["logs"], "ocr_queue.json"))
+
+        # Check which documents have been consumed
+        if "consumption" in due:
+            check_consumption(dirs["consumption"])
+
+        if metrics_file is not None and (time.time() -
+                                         last_metrics) >= METRICS_INTERVAL:
+            write_metrics(metrics_file)
+            last_metrics = time.time()
+
+    logging.info("Shutting down")
+    close_email_fetcher(email_fetcher)
+    close_ingestion(ingestion, dirs["parse_fail"])
+    close_mirror(mirror)
+    close_repair(repair, dirs)
+    if ocr is not None:
+        close_local_ocr(ocr, dirs)
+    close_watcher(watcher)
+    close_metrics(metrics)
+    close_trace()
     close_database(connection)
 
 
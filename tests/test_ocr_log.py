@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+# coding=utf8
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import orchestrator  # noqa: E402
+
+LOG_SUCCESS = ("12:00:00: Verarbeitung gestartet\r\n"
+               "Verarbeitete Seiten: {pages}.\r\n"
+               "Erkennungszeit: 0 Stunden 1 Minuten 5 Sekunden.\r\n"
+               "Fehler/Warnungen: 0 / 2.\r\n"
+               "Nicht eindeutige Zeichen: 1 % (10 / 1000).\r\n")
+LOG_FAILURE = ("12:00:00: Fehler: Datei {number} kann nicht gelesen werden\r\n"
+               "Verarbeitete Seiten: 0.\r\n"
+               "Erkennungszeit: 0 Stunden 0 Minuten 0 Sekunden.\r\n"
+               "Fehler/Warnungen: 1 / 0.\r\n")
+
+
+class OcrLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def parse(self, *documents, max_sections=None):
+        path = os.path.join(self.root.name, "log.txt")
+        with open(path, "w", encoding="utf-16le", newline="") as file:
+            file.write("\ufeff" + "".join(documents))
+        return orchestrator.parse_ocr_log_sections(path, max_sections)
+
+    def assertSection(self, section, error):
+        self.assertEqual(section["Successful"], error is None)
+        self.assertEqual(section["Error_Message"], error)
+
+    def test_ok_fail(self):
+        sections = self.parse(LOG_SUCCESS.format(pages=3),
+                              LOG_FAILURE.format(number=2))
+        self.assertEqual(len(sections), 2)
+        self.assertSection(sections[0], None)
+        self.assertEqual(sections[0]["Pages"], 3)
+        self.assertEqual(sections[0]["Time"], 65)
+        self.assertEqual(sections[0]["Chars_Total"], 1000)
+        self.assertSection(sections[1],
+                           "Datei 2 kann nicht gelesen werden")
+        self.assertEqual(sections[1]["Errors"], 1)
+
+    def test_fail_ok(self):
+        sections = self.parse(LOG_FAILURE.format(number=1),
+                              LOG_SUCCESS.format(pages=4))
+        self.assertEqual(len(sections), 2)
+        self.assertSection(sections[0],
+                           "Datei 1 kann nicht gelesen werden")
+        self.assertEqual(sections[0]["Pages"], 0)
+        self.assertSection(sections[1], None)
+        self.assertEqual(sections[1]["Pages"], 4)
+
+    def test_fail_fail(self):
+        sections = self.parse(LOG_FAILURE.format(number=1),
+                              LOG_FAILURE.format(number=2))
+        self.assertEqual(len(sections), 2)
+        self.assertSection(sections[0],
+                           "Datei 1 kann nicht gelesen werden")
+        self.assertSection(sections[1],
+                           "Datei 2 kann nicht gelesen werden")
+
+    def test_late_error_fails_single_document(self):
+        sections = self.parse(LOG_SUCCESS.format(pages=3),
+                              "12:00:09: Fehler: Speichern fehlgeschlagen\r\n",
+                              max_sections=1)
+        self.assertEqual(len(sections), 1)
+        self.assertSection(sections[0], "Speichern fehlgeschlagen")
+        self.assertEqual(sections[0]["Pages"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
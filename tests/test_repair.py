@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+# coding=utf8
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import orchestrator  # noqa: E402
+
+
+class FailedRepairTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.dirs = {}
+        for key in ["ocr_queue", "ocr_repair", "ocr_fail", "ocr_in"]:
+            self.dirs[key] = os.path.join(self.root.name, key)
+            os.mkdir(self.dirs[key])
+        orchestrator.open_database(self.root.name)
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_failed_repair_leaves_repair_folder(self):
+        pathname = os.path.join(self.dirs["ocr_in"], "scan.pdf")
+        with open(pathname, "wb") as file:
+            file.write(b"%PDF-1.4 damaged")
+
+        orchestrator.fail_ocr_file(pathname, self.dirs["ocr_fail"],
+                                   self.dirs["ocr_repair"], "OCR failed")
+
+        repaired = os.path.join(self.dirs["ocr_repair"], "scan_r.pdf")
+        orchestrator.mark_file_closed(repaired)
+
+        # Without mutool on the PATH the repair fails
+        repair = orchestrator.open_repair()
+        with mock.patch.dict(os.environ, {"PATH": self.root.name}):
+            orchestrator.dispatch_repairs(repair, self.dirs)
+            self.assertEqual(list(repair["active"]), ["scan_r.pdf"])
+            while not orchestrator.reap_repairs(repair, self.dirs):
+                time.sleep(0.05)
+        repair["executor"].shutdown(wait=True)
+
+        self.assertEqual(os.listdir(self.dirs["ocr_repair"]), [])
+        self.assertEqual(os.listdir(self.dirs["ocr_fail"]), ["scan.pdf"])
+        self.assertEqual(os.listdir(self.dirs["ocr_queue"]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# coding=utf8
+
+import os
+import random
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import orchestrator  # noqa: E402
+
+
+def get_text(rng):
+    return [
+        rng.getrandbits(64)
+        for _ in range(orchestrator.MINHASH_PERMUTATIONS)
+    ]
+
+
+def pack_text(text):
+    return struct.pack("<{:d}Q".format(orchestrator.MINHASH_PERMUTATIONS),
+                       *text)
+
+
+def flip_bits(value, count, rng):
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+class SimilarityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def test_same_text_is_similar(self):
+        text = get_text(self.rng)
+        self.assertTrue(
+            orchestrator.is_similar({
+                "text": text,
+                "image": None
+            }, pack_text(text), None))
+
+    def test_different_text_wins_over_same_image(self):
+        # Different letters on the same letterhead
+        image = self.rng.getrandbits(64)
+        self.assertFalse(
+            orchestrator.is_similar(
+                {
+                    "text": get_text(self.rng),
+                    "image": image
+                }, pack_text(get_text(self.rng)), "{:016x}".format(image)))
+
+    def test_image_decides_without_text(self):
+        image = self.rng.getrandbits(64)
+        near = flip_bits(image, orchestrator.DHASH_DISTANCE, self.rng)
+        far = flip_bits(image, orchestrator.DHASH_DISTANCE + 1, self.rng)
+        similarity = {"text": None, "image": image}
+
+        self.assertTrue(
+            orchestrator.is_similar(similarity, None, "{:016x}".format(near)))
+        self.assertFalse(
+            orchestrator.is_similar(similarity, None, "{:016x}".format(far)))
+        self.assertTrue(
+            orchestrator.is_similar(similarity, pack_text(get_text(self.rng)),
+                                    "{:016x}".format(near)))
+
+    def test_near_images_share_a_bucket(self):
+        for _ in range(1000):
+            image = self.rng.getrandbits(64)
+            near = flip_bits(image,
+                             self.rng.randint(0, orchestrator.DHASH_DISTANCE),
+                             self.rng)
+            left = orchestrator.get_similarity_buckets({
+                "text": None,
+                "image": image
+            })
+            right = orchestrator.get_similarity_buckets({
+                "text": None,
+                "image": near
+            })
+            self.assertTrue(set(left) & set(right))
+
+    def test_find_near_duplicate(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        orchestrator.open_database(root.name)
+
+        text = get_text(self.rng)
+        image = self.rng.getrandbits(64)
+        orchestrator.save_similarity("a.pdf", {"text": text, "image": image})
+        orchestrator.save_similarity("b.pdf", {"text": None, "image": image})
+
+        self.assertEqual(
+            orchestrator.find_near_duplicate({
+                "text": text,
+                "image": None
+            }), "a.pdf")
+        # Only the scan without text is matched on its page hash
+        self.assertEqual(
+            orchestrator.find_near_duplicate({
+                "text": get_text(self.rng),
+                "image": image
+            }), "b.pdf")
+        self.assertEqual(
+            orchestrator.find_near_duplicate({
+                "text": None,
+                "image": flip_bits(image, 3, self.rng)
+            }), "a.pdf")
+
+
+if __name__ == "__main__":
+    unittest.main()